@@ -0,0 +1,215 @@
+""" amenities.py ==============================================================
+A precomputed list of the places near every charging station, so "a charger
+near coffee" can be answered from a local lookup instead of a live Yelp
+search on every request.
+
+For each station we keep the top few places in each category (coffee, food,
+shopping, ...) within walking distance, along with their rating and distance.
+These are saved to a SQLite database, which the skill reads from and the
+batch job below writes to. Stations and the places near them barely change,
+so there's no rush to keep it all up to date. Each run of the job only
+refreshes the stations that are missing or older than MAX_AGE, BATCH at a
+time, so that a run stays well inside our Yelp quota:
+
+    python amenities.py update [how many stations]
+
+Run it from a cron job. Stations that NREL has dropped get removed on each run.
+
+Which category a request falls under is worked out from the words the user
+said. Only whole words count, so "steakhouse" isn't coffee just because it
+has "tea" in it (tests/test_amenities.py tries a few of these). If they
+didn't say anything, we look at every category. If what they said doesn't
+match any of our categories, or the stations haven't been indexed yet, we go
+back to searching Yelp live (see skills.py).
+=========================================================================== """
+import re, sqlite3, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from config import logger, settings
+from utils import fetch_yelp_results
+
+
+# Used when instance/config.yaml doesn't list any categories.
+CATEGORIES = {'coffee': {'YELP': 'coffee,cafes', 'KEYWORDS': ['coffee', 'cafe', 'tea', 'espresso']},
+              'food': {'YELP': 'restaurants', 'KEYWORDS': ['food', 'restaurant', 'eat', 'lunch',
+                                                           'dinner', 'breakfast']},
+              'shopping': {'YELP': 'shopping', 'KEYWORDS': ['shopping', 'shop', 'store', 'mall']}}
+
+
+class AmenityIndex:
+    """ Station id -> nearby places by category, stored in SQLite. """
+
+    def __init__(self, path, categories=None, radius=840, per_category=5):
+        self.path = path
+        self.categories = categories or CATEGORIES
+        self.radius = radius
+        self.per_category = per_category
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS amenity_stations ("
+                         "station_id INTEGER PRIMARY KEY, "
+                         "updated_at REAL NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS amenities ("
+                         "station_id INTEGER NOT NULL, "
+                         "category TEXT NOT NULL, "
+                         "rank INTEGER NOT NULL, "
+                         "name TEXT NOT NULL, "
+                         "rating REAL, "
+                         "distance REAL, "
+                         "PRIMARY KEY (station_id, category, rank))")
+        self._db.commit()
+
+    def categories_for(self, keyword):
+        """ The categories a keyword belongs to. No keyword means all of them,
+            and None means we don't know what they're asking for. """
+        if not keyword:
+            return list(self.categories)
+        keyword = str(keyword).lower()
+        matches = [name for name, category in self.categories.items()
+                   if any(re.search(r'\b{}\b'.format(re.escape(str(word).lower())), keyword)
+                          for word in [name] + list(category.get('KEYWORDS', [])))]
+        return matches or None
+
+    def near(self, station_ids, categories):
+        """ Returns ({station id: [place, ...]}, set of indexed station ids)
+            for a batch of stations, in a single query. Places are best rated
+            first, and come back in the same shape as Yelp's businesses. """
+        station_ids = list(set(station_ids))
+        if not station_ids:
+            return {}, set()
+        ids = ','.join('?' * len(station_ids))
+        names = ','.join('?' * len(categories))
+        with self._lock:
+            indexed = {row[0] for row in self._db.execute(
+                "SELECT station_id FROM amenity_stations WHERE station_id IN ({})".format(ids),
+                station_ids)}
+            rows = self._db.execute(
+                "SELECT station_id, name, rating, distance FROM amenities "
+                "WHERE station_id IN ({}) AND category IN ({})".format(ids, names),
+                station_ids + list(categories)).fetchall()
+
+        places = {}
+        for station_id, name, rating, distance in rows:
+            places.setdefault(station_id, []).append({'name': name, 'rating': rating,
+                                                      'distance': distance})
+        for found in places.values():
+            found.sort(key=lambda place: (-(place['rating'] or 0), place['distance'] or 0))
+        return places, indexed
+
+    def best(self, stations, keyword):
+        """ Picks the first station (in the order given) that has somewhere
+            to go nearby, and returns (station, {'businesses': places}). If
+            none of them have anything, returns (first station, None). Returns
+            None if we can't answer this one locally. """
+        categories = self.categories_for(keyword)
+        stations = [s for s in stations if s.id is not None]
+        if categories is None or not stations:
+            return None
+
+        places, indexed = self.near([int(s.id) for s in stations], categories)
+        for station in stations:
+            if places.get(int(station.id)):
+                return station, {'businesses': places[int(station.id)]}
+        # Only say there's nothing nearby if we've actually looked everywhere.
+        if all(int(s.id) in indexed for s in stations):
+            return stations[0], None
+        return None
+
+    def due(self, stations, max_age, limit):
+        """ The stations that need (re)fetching, never fetched ones first,
+            then the oldest. """
+        with self._lock:
+            updated = dict(self._db.execute("SELECT station_id, updated_at FROM amenity_stations"))
+        cutoff = time.time() - max_age
+        stale = [s for s in stations if s.id is not None and updated.get(int(s.id), 0) < cutoff]
+        stale.sort(key=lambda s: updated.get(int(s.id), 0))
+        return stale[:limit]
+
+    def fetch(self, station):
+        """ Searches Yelp around a station for each of our categories. """
+        found = {}
+        for name, category in self.categories.items():
+            results = fetch_yelp_results(station.location, None, categories=category['YELP'],
+                                         radius=self.radius, limit=self.per_category,
+                                         sort_by='rating')
+            found[name] = [(b['name'], b.get('rating'), b.get('distance'))
+                           for b in results.get('businesses') or []
+                           if (b.get('distance') or 0) <= self.radius]
+        return found
+
+    def put(self, station_id, found):
+        """ Replaces everything we know about one station. """
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM amenities WHERE station_id = ?", (station_id,))
+                self._db.executemany("INSERT INTO amenities VALUES (?, ?, ?, ?, ?, ?)",
+                                     [(station_id, category, rank, name, rating, distance)
+                                      for category, places in found.items()
+                                      for rank, (name, rating, distance) in enumerate(places)])
+                self._db.execute("INSERT OR REPLACE INTO amenity_stations VALUES (?, ?)",
+                                 (station_id, time.time()))
+
+    def prune(self, stations):
+        """ Forgets stations that are no longer in the dataset. """
+        keep = {int(s.id) for s in stations if s.id is not None}
+        with self._lock:
+            known = [row[0] for row in self._db.execute("SELECT station_id FROM amenity_stations")]
+            gone = [(station_id,) for station_id in known if station_id not in keep]
+            with self._db:
+                self._db.executemany("DELETE FROM amenities WHERE station_id = ?", gone)
+                self._db.executemany("DELETE FROM amenity_stations WHERE station_id = ?", gone)
+        return len(gone)
+
+    def update(self, stations, max_age=2592000, limit=1000, workers=4):
+        """ Refreshes up to 'limit' of the stations that are due. Stations
+            that fail are left alone, and get picked up again next run. """
+        pruned = self.prune(stations)
+        due = self.due(stations, max_age, limit)
+        logger.info("Refreshing amenities for {} stations ({} removed).".format(len(due), pruned))
+
+        def refresh(station):
+            try:
+                self.put(int(station.id), self.fetch(station))
+                return True
+            except Exception as e:
+                logger.warning("Amenity lookup failed for station {}: {}".format(station.id, e))
+                return False
+
+        with ThreadPoolExecutor(workers) as pool:
+            return sum(pool.map(refresh, due))
+
+
+def make_amenity_index():
+    """ Builds our amenity index from the "Amenities" block of our config. """
+    config = settings.get('Amenities') or {}
+    return AmenityIndex(config.get('PATH', 'instance/amenities.db'),
+                        categories=config.get('CATEGORIES'),
+                        radius=config.get('RADIUS', 840),
+                        per_category=config.get('PER_CATEGORY', 5))
+
+
+# This is the amenity index shared by the whole app.
+amenity_index = make_amenity_index()
+
+
+if __name__ == '__main__':
+    from index import fetch_all_stations
+    from snapshot import Snapshot
+
+    command, args = (sys.argv[1:2] or [''])[0], sys.argv[2:]
+    if command != 'update':
+        print(__doc__)
+        sys.exit(1)
+
+    config = settings.get('Amenities') or {}
+    path = settings['Index'].get('SNAPSHOT')
+    try:
+        snapshot = Snapshot(path) if path else None
+    except FileNotFoundError:
+        snapshot = None
+    stations = [snapshot[row] for row in range(len(snapshot))] if snapshot else fetch_all_stations()
+
+    limit = int(args[0]) if args else config.get('BATCH', 1000)
+    updated = amenity_index.update(stations, max_age=config.get('MAX_AGE', 2592000),
+                                   limit=limit, workers=config.get('WORKERS', 4))
+    print("Refreshed amenities for {} stations.".format(updated))
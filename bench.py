@@ -0,0 +1,522 @@
+""" bench.py ==================================================================
+An offline load test for the skill. It replays recorded Alexa request
+envelopes through run.py's Flask app. NREL, Yelp, HERE and the Device Address
+API are all swapped out for in-process stubs, so it runs on any box with no
+network connection and no API keys.
+
+    python bench.py --requests 2000 --concurrency 16
+    python bench.py --latency nrel=0.2,yelp=0.15 --errors yelp=0.05
+    python bench.py --save baseline.json
+    python bench.py --compare baseline.json
+
+Envelopes come from the envelopes/ folder by default. You can also pass your
+own files: a single envelope, or a trace file or dump (see tracing.py), in
+which case every captured request gets replayed. Each replay gets a fresh
+request id and timestamp. Envelopes that share a session are played back in
+order, as one conversation, under a new session id ('--think' adds a pause
+between turns). Each conversation also gets a device id drawn from a pool, so
+the device store sees a mix of new and returning devices.
+
+Each stub waits for roughly its configured latency (give or take half) before
+answering. It fails with a 503 at its configured error rate, and with a read
+timeout if it would take longer than the client is willing to wait.
+
+At the end we print the throughput, and latency percentiles per intent as
+seen by the client. We also print the skill's own stage and provider numbers
+(see metrics.py). Save the results to JSON, and you can compare two commits
+against the same settings.
+=========================================================================== """
+import argparse, json, os, random, sys, tempfile, threading, time, uuid
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import requests
+from requests.adapters import BaseAdapter
+from ask_sdk_model.services import ApiClient, ApiClientResponse
+from config import settings
+
+
+ENVELOPES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'envelopes')
+
+# Mean latency (in seconds) and error rate for each stub, unless overridden.
+LATENCY = {'NREL': 0.15, 'YELP': 0.1, 'HERE': 0.08, 'DEVICE': 0.05}
+ERRORS = {'NREL': 0.0, 'YELP': 0.0, 'HERE': 0.0, 'DEVICE': 0.0}
+
+NETWORKS = ('ChargePoint Network', 'Blink Network', 'EV Connect',
+            'Electrify America', 'Non-Networked')
+CONNECTORS = (['J1772'], ['J1772', 'J1772COMBO'], ['CHADEMO', 'J1772COMBO'],
+              ['TESLA'], ['NEMA515', 'J1772'])
+PRICING = ('Free', '$0.25 per kWh', '$2.00 per hour', None)
+BUSINESSES = ('Cafe', 'Coffee Co.', 'Diner', 'Bakery', 'Market', 'Pizza')
+
+METERS_PER_MILE = 1609.344
+
+
+def make_stations(count, center, spread=1.5, seed=0):
+    """ Makes up a set of NREL style station dicts scattered around a point. """
+    rng = random.Random(seed)
+    stations = []
+    for i in range(count):
+        stations.append({'id': i + 1,
+                         'fuel_type_code': 'ELEC',
+                         'station_name': 'Bench Station {}'.format(i + 1),
+                         'street_address': '{} Main St'.format(rng.randint(1, 9999)),
+                         'city': 'Seattle',
+                         'state': 'WA',
+                         'zip': '98101',
+                         'latitude': center[0] + rng.uniform(-spread, spread),
+                         'longitude': center[1] + rng.uniform(-spread, spread),
+                         'ev_network': rng.choice(NETWORKS),
+                         'ev_pricing': rng.choice(PRICING),
+                         'ev_connector_types': rng.choice(CONNECTORS),
+                         'ev_level1_evse_num': rng.choice((None, 1, 2)),
+                         'ev_level2_evse_num': rng.randint(1, 8),
+                         'ev_dc_fast_num': rng.choice((None, None, 2, 4)),
+                         'access_days_time': '24 hours daily'})
+    return stations
+
+
+def miles_between(lat1, lon1, lats, lons):
+    """ Haversine distance in miles from one point to arrays of points. """
+    lat1, lon1, lats, lons = map(np.radians, (lat1, lon1, lats, lons))
+    a = (np.sin((lats - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lats) * np.sin((lons - lon1) / 2) ** 2)
+    return 3959 * 2 * np.arcsin(np.sqrt(a))
+
+
+def parse_point(value):
+    """ Reads a HERE waypoint like 'geo!47.6,-122.3'. """
+    lat, lon = value.split('!')[-1].split(',')
+    return float(lat), float(lon)
+
+
+class StubAdapter(BaseAdapter):
+    """ A requests transport that answers in-process instead of going out over
+        the network. Mount it on a session like any other adapter. """
+
+    def __init__(self, handler, latency=0.0, error_rate=0.0, seed=None):
+        super().__init__()
+        self.handler = handler
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        delay = self.rng.uniform(0.5, 1.5) * self.latency
+        read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+        if read_timeout is not None and delay > read_timeout:
+            time.sleep(read_timeout)
+            raise requests.ReadTimeout("Stub took longer than {}s.".format(read_timeout),
+                                       request=request)
+        time.sleep(delay)
+
+        if self.rng.random() < self.error_rate:
+            status, body = 503, {'error': 'Injected failure.'}
+        else:
+            url = urlparse(request.url)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if request.body:
+                body = request.body.decode() if isinstance(request.body, bytes) else request.body
+                params.update({k: v[0] for k, v in parse_qs(body).items()})
+            status, body = self.handler(url.path, params)
+
+        response = requests.Response()
+        response.status_code = status
+        response.reason = 'OK' if status < 400 else 'Error'
+        response._content = json.dumps(body).encode('utf-8')
+        response.headers['Content-Type'] = 'application/json'
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class ProviderStubs:
+    """ Canned answers for every provider endpoint the skill calls. """
+
+    def __init__(self, stations, center, serve_bulk=True):
+        self.stations = stations
+        self.center = center
+        self.serve_bulk = serve_bulk
+        self.lats = np.array([s['latitude'] for s in stations])
+        self.lons = np.array([s['longitude'] for s in stations])
+
+    def _nearest(self, lat, lon, limit, miles=None):
+        distances = miles_between(lat, lon, self.lats, self.lons)
+        order = np.argsort(distances)[:limit]
+        if miles is not None:
+            order = order[distances[order] <= miles]
+        return [dict(self.stations[i], distance=float(distances[i])) for i in order]
+
+    def nrel(self, path, params):
+        if path.endswith('last-updated.json'):
+            return 200, {'last_updated': '2019-11-20 00:00:00 UTC'}
+        if path.endswith('nearest.json'):
+            if 'latitude' in params:
+                lat, lon = float(params['latitude']), float(params['longitude'])
+            else:
+                lat, lon = self.center
+            stations = self._nearest(lat, lon, int(params.get('limit', 20)),
+                                     float(params.get('radius', 5.0)))
+            return 200, {'fuel_stations': stations, 'total_results': len(stations)}
+        if path.endswith('nearby-route.json'):
+            points = params['route'][len('LINESTRING('):-1].split(',')
+            stations = {}
+            for point in points:
+                lon, lat = map(float, point.split())
+                for station in self._nearest(lat, lon, 50, float(params.get('distance', 2.0))):
+                    stations[station['id']] = station
+            return 200, {'fuel_stations': list(stations.values()), 'total_results': len(stations)}
+        if path.endswith('v1.json'):
+            # A 404 rather than a 5xx, so that turning off the index doesn't
+            # count against NREL's circuit breaker.
+            if not self.serve_bulk:
+                return 404, {'error': 'Bulk download is turned off.'}
+            return 200, {'fuel_stations': self.stations, 'total_results': len(self.stations)}
+        return 404, {'error': 'Unknown NREL endpoint.'}
+
+    def yelp(self, path, params):
+        rng = random.Random('{}|{}|{}'.format(params.get('latitude'), params.get('longitude'),
+                                              params.get('term')))
+        businesses = [{'name': '{} {}'.format(params.get('term') or 'Local', rng.choice(BUSINESSES)),
+                       'rating': rng.choice((3.5, 4.0, 4.5, 5.0)),
+                       'distance': rng.uniform(50, 840)}
+                      for _ in range(rng.choice((0, 1, 3, 5)))]
+        return 200, {'businesses': businesses, 'total': len(businesses)}
+
+    def here(self, path, params):
+        if path.endswith('geocode.json'):
+            rng = random.Random(params.get('searchtext'))
+            position = {'Latitude': self.center[0] + rng.uniform(-0.2, 0.2),
+                        'Longitude': self.center[1] + rng.uniform(-0.2, 0.2)}
+            return 200, {'Response': {'View': [{'Result': [{'Location': {'DisplayPosition': position}}]}]}}
+        if path.endswith('calculatematrix.json'):
+            origin = parse_point(params['start0'])
+            entries, i = [], 0
+            while 'destination{}'.format(i) in params:
+                lat, lon = parse_point(params['destination{}'.format(i)])
+                meters = float(miles_between(origin[0], origin[1], lat, lon)) * METERS_PER_MILE * 1.3
+                entries.append({'startIndex': 0, 'destinationIndex': i,
+                                'summary': {'travelTime': int(meters / 13.4), 'distance': int(meters)}})
+                i += 1
+            return 200, {'response': {'matrixEntry': entries}}
+        if path.endswith('calculateroute.json'):
+            (lat1, lon1), (lat2, lon2) = parse_point(params['waypoint0']), parse_point(params['waypoint1'])
+            meters = float(miles_between(lat1, lon1, lat2, lon2)) * METERS_PER_MILE * 1.3
+            return 200, {'response': {'route': [{'summary': {'distance': int(meters),
+                                                             'travelTime': int(meters / 13.4)}}]}}
+        return 404, {'error': 'Unknown HERE endpoint.'}
+
+
+class StubApiClient(ApiClient):
+    """ Stands in for the Alexa service APIs (Device Address, and anything
+        else we call through the service client factory). """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+
+    def invoke(self, request):
+        time.sleep(self.rng.uniform(0.5, 1.5) * self.latency)
+        if self.rng.random() < self.error_rate:
+            return ApiClientResponse(status_code=500, body=json.dumps({'message': 'Injected failure.'}),
+                                     headers=[('Content-Type', 'application/json')])
+        if '/settings/address' in request.url:
+            rng = random.Random(request.url)
+            address = {'addressLine1': '{} Pine St'.format(rng.randint(1, 9999)),
+                       'city': 'Seattle', 'stateOrRegion': 'WA',
+                       'countryCode': 'US', 'postalCode': '98101'}
+            return ApiClientResponse(status_code=200, body=json.dumps(address),
+                                     headers=[('Content-Type', 'application/json')])
+        return ApiClientResponse(status_code=204, body=None, headers=[])
+
+
+def parse_options(text, defaults):
+    """ Reads 'nrel=0.2,yelp=0.1' into a copy of defaults, keyed in upper case. """
+    options = dict(defaults)
+    for item in filter(None, (text or '').split(',')):
+        name, value = item.split('=')
+        name = name.strip().upper()
+        if name not in options:
+            raise SystemExit("Unknown stub '{}', expected one of {}.".format(name, ', '.join(options)))
+        options[name] = float(value)
+    return options
+
+
+def load_envelopes(paths):
+    """ Reads request envelopes from files or folders. A file can hold a
+        single envelope, or be a trace file or dump from tracing.py. """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.endswith(('.json', '.jsonl')))
+        else:
+            files.append(path)
+
+    envelopes = []
+    for path in files:
+        with open(path) as f:
+            if path.endswith('.jsonl'):
+                entries = [json.loads(line) for line in f if line.strip()]
+            else:
+                data = json.load(f)
+                entries = data if isinstance(data, list) else [data]
+        for entry in entries:
+            if 'request' in entry and 'context' in entry:
+                envelopes.append(entry)
+            elif entry.get('kind') == 'request':
+                envelopes.append(entry['payload'])
+    return envelopes
+
+
+def intent_of(envelope):
+    request = envelope['request']
+    if request['type'] == 'IntentRequest':
+        return request['intent']['name']
+    return request['type']
+
+
+def prepare(envelope, session_id, device_id):
+    """ Makes a copy of an envelope that looks like a brand new request. """
+    envelope = json.loads(json.dumps(envelope))
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    envelope['request']['requestId'] = 'amzn1.echo-api.request.' + str(uuid.uuid4())
+    envelope['request']['timestamp'] = now
+    envelope['context']['System']['device']['deviceId'] = device_id
+    if envelope.get('session'):
+        envelope['session']['sessionId'] = session_id
+    if 'Geolocation' in envelope['context']:
+        envelope['context']['Geolocation']['timestamp'] = now
+    return envelope
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    values = np.array(samples) * 1000
+    return {'count': len(samples),
+            'mean_ms': round(float(values.mean()), 3),
+            'p50_ms': round(float(np.percentile(values, 50)), 3),
+            'p95_ms': round(float(np.percentile(values, 95)), 3),
+            'p99_ms': round(float(np.percentile(values, 99)), 3),
+            'max_ms': round(float(values.max()), 3)}
+
+
+def install_stubs(latency, errors, stations, seed=0, serve_bulk=True):
+    """ Swaps NREL, Yelp and HERE for stubs, with stations scattered around
+        our debug location. Also used by coldstart.py. """
+    center = (settings['Debug']['Lat'], settings['Debug']['Long'])
+    stubs = ProviderStubs(make_stations(stations, center, seed=seed), center, serve_bulk=serve_bulk)
+
+    from providers import get_client
+    for client, name, handler in (('NREL', 'NREL', stubs.nrel), ('NREL_BULK', 'NREL', stubs.nrel),
+                                  ('YELP', 'YELP', stubs.yelp), ('HERE', 'HERE', stubs.here)):
+        adapter = StubAdapter(handler, latency[name], errors[name], seed=seed)
+        session = get_client(client).session
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+    return stubs
+
+
+def setup(args):
+    """ Points the app's storage at a scratch folder, plugs in the stubs, then
+        imports run.py. This has to happen before anything reads the config. """
+    scratch = tempfile.mkdtemp(prefix='waypoint-bench-')
+    settings['Devices']['PATH'] = os.path.join(scratch, 'devices.db')
+    settings['Trace']['PATH'] = os.path.join(scratch, 'trace.jsonl')
+    settings.setdefault('Amenities', {})['PATH'] = os.path.join(scratch, 'amenities.db')
+    settings.setdefault('Profiles', {})['PATH'] = os.path.join(scratch, 'profiles.db')
+    settings['Index']['SNAPSHOT'] = None
+    # Debug mode skips the location lookup and traces every request, which
+    # isn't what we want to measure.
+    settings['Debug']['debugMode'] = False
+    logging.getLogger().setLevel(logging.WARNING)
+
+    latency = parse_options(args.latency, LATENCY)
+    errors = parse_options(args.errors, ERRORS)
+    stubs = install_stubs(latency, errors, args.stations, seed=args.seed, serve_bulk=args.index)
+
+    from providers import get_client
+    import run
+    skill = run.create_skill_builder(StubApiClient(latency['DEVICE'], errors['DEVICE'], args.seed))
+    app = run.create_app(skill.create(), verify=False)
+
+    if args.amenities:
+        # Build the amenity index against the stubs, without their latency.
+        from amenities import amenity_index
+        from models import Station
+        yelp = get_client('YELP').session.get_adapter('https://')
+        yelp.latency, yelp.error_rate = 0.0, 0.0
+        amenity_index.update([Station.from_dict(s) for s in stubs.stations], limit=len(stubs.stations))
+        yelp.latency, yelp.error_rate = latency['YELP'], errors['YELP']
+
+    if args.index:
+        started = time.perf_counter()
+        while not run.station_index.ready:
+            if time.perf_counter() - started > 60:
+                raise SystemExit("Station index didn't load.")
+            time.sleep(0.05)
+    return app, {'latency': latency, 'errors': errors, 'stations': args.stations,
+                 'index': args.index, 'amenities': args.amenities, 'concurrency': args.concurrency,
+                 'requests': args.requests, 'devices': args.devices, 'think': args.think}
+
+
+def group_sessions(envelopes):
+    """ Groups envelopes into conversations by their session id, keeping them
+        in order. Requests without a session are a conversation of one. """
+    sessions = OrderedDict()
+    for k, envelope in enumerate(envelopes):
+        session_id = (envelope.get('session') or {}).get('sessionId') or k
+        sessions.setdefault(session_id, []).append(envelope)
+    return list(sessions.values())
+
+
+def replay(app, envelopes, count, concurrency, devices, think=0.0, seed=0):
+    """ Sends count requests at the given concurrency. Each worker plays a
+        whole conversation at a time, waiting 'think' seconds between turns.
+        Returns the elapsed time and, for each intent, the latencies and
+        number of failures. """
+    rng = random.Random(seed)
+    conversations, plan, planned = group_sessions(envelopes), [], 0
+    while planned < count:
+        turns = conversations[len(plan) % len(conversations)][:count - planned]
+        plan.append((turns, 'amzn1.echo-api.session.' + str(uuid.uuid4()),
+                     'amzn1.ask.device.bench-{}'.format(rng.randrange(devices))))
+        planned += len(turns)
+    results = {}
+    lock = threading.Lock()
+    local = threading.local()
+
+    # Our exception handlers still answer with a 200, so a request that
+    # failed looks like any other, apart from what we say back.
+    from skills import ERROR, PROBLEM, TIMEOUT, LOCATION_FAILURE
+    failed = ['<speak>{}</speak>'.format(speech) for speech in (ERROR, PROBLEM, TIMEOUT, LOCATION_FAILURE)]
+
+    def send(item):
+        turns, session_id, device_id = item
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        for k, envelope in enumerate(turns):
+            if k and think:
+                time.sleep(think)
+            body = prepare(envelope, session_id, device_id)
+            started = time.perf_counter()
+            response = client.post('/', json=body)
+            elapsed = time.perf_counter() - started
+            speech = ((response.get_json(silent=True) or {}).get('response') or {}).get('outputSpeech') or {}
+            with lock:
+                latencies, failures = results.setdefault(intent_of(envelope), ([], [0]))
+                latencies.append(elapsed)
+                if response.status_code != 200 or speech.get('ssml') in failed:
+                    failures[0] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency, thread_name_prefix='bench') as pool:
+        list(pool.map(send, plan))
+    return time.perf_counter() - started, results
+
+
+def compare(result, baseline):
+    """ Prints how this run did next to a saved one. """
+    def change(new, old):
+        if not old or new is None:
+            return ''
+        return '{:+.1f}%'.format(100.0 * (new - old) / old)
+
+    print("\nCompared with {}:".format(baseline['started']))
+    print("  {:<28}{:>12}{:>12}{:>10}".format('', 'baseline', 'now', 'change'))
+    print("  {:<28}{:>12.1f}{:>12.1f}{:>10}".format('throughput (req/s)', baseline['throughput'],
+                                                   result['throughput'],
+                                                   change(result['throughput'], baseline['throughput'])))
+    for intent, summary in sorted(result['intents'].items()):
+        old = baseline['intents'].get(intent) or {}
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if key in old:
+                print("  {:<28}{:>12.1f}{:>12.1f}{:>10}".format('{} {}'.format(intent, key), old[key],
+                                                               summary[key], change(summary[key], old[key])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay Alexa requests against stubbed providers.")
+    parser.add_argument('envelopes', nargs='*', default=[ENVELOPES],
+                        help="envelope files, trace files or folders (default: envelopes/)")
+    parser.add_argument('-n', '--requests', type=int, default=500)
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=50,
+                        help="requests to send before we start measuring")
+    parser.add_argument('--latency', help="mean stub latency in seconds, e.g. nrel=0.2,yelp=0.1")
+    parser.add_argument('--errors', help="stub error rates, e.g. yelp=0.05,here=0.1")
+    parser.add_argument('--stations', type=int, default=5000, help="size of the fake station dataset")
+    parser.add_argument('--devices', type=int, default=100, help="how many distinct devices to simulate")
+    parser.add_argument('--think', type=float, default=0.0,
+                        help="seconds a user takes between turns of a conversation")
+    parser.add_argument('--no-index', dest='index', action='store_false',
+                        help="don't load the local station index, so every lookup goes to NREL")
+    parser.add_argument('--amenities', action='store_true',
+                        help="build the amenity index first, instead of searching Yelp live")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="compare against results saved with --save")
+    args = parser.parse_args()
+
+    envelopes = load_envelopes(args.envelopes)
+    if not envelopes:
+        raise SystemExit("No request envelopes found in {}.".format(', '.join(args.envelopes)))
+
+    app, options = setup(args)
+    from metrics import metrics
+    from cache import station_cache, yelp_cache, drive_time_cache
+    from prefetch import prefetcher
+    from profiles import profiles
+
+    if args.warmup:
+        replay(app, envelopes, args.warmup, args.concurrency, args.devices, args.think, args.seed + 1)
+    metrics.reset()
+
+    elapsed, results = replay(app, envelopes, args.requests, args.concurrency, args.devices,
+                              args.think, args.seed)
+    result = {'started': datetime.now(timezone.utc).isoformat(),
+              'options': options,
+              'elapsed': round(elapsed, 3),
+              'throughput': round(args.requests / elapsed, 2),
+              'intents': {intent: dict(percentiles(latencies), failures=failures[0])
+                          for intent, (latencies, failures) in results.items()},
+              'server': metrics.report(),
+              'cache': {c.name: c.stats() for c in (station_cache, yelp_cache, drive_time_cache)},
+              'prefetch': prefetcher.stats(),
+              'profiles': profiles.stats()}
+
+    print("{} requests in {:.2f}s at concurrency {}: {:.1f} req/s".format(
+          args.requests, elapsed, args.concurrency, result['throughput']))
+    print("\n  {:<28}{:>7}{:>7}{:>10}{:>10}{:>10}{:>10}".format(
+          'client', 'count', 'fail', 'mean', 'p50', 'p95', 'p99'))
+    for intent, s in sorted(result['intents'].items()):
+        print("  {:<28}{:>7}{:>7}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+              intent, s['count'], s['failures'], s['mean_ms'], s['p50_ms'], s['p95_ms'], s['p99_ms']))
+    print("\n  {:<28}{:>7}{:>7}{:>10}{:>10}{:>10}{:>10}".format(
+          'server', 'count', 'err', 'mean', 'p50', 'p95', 'p99'))
+    for name, s in result['server'].items():
+        print("  {:<28}{:>7}{:>7}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+              name, s['count'], s['errors'] + s['timeouts'], s['mean_ms'], s['p50_ms'],
+              s['p95_ms'], s['p99_ms']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+        print("\nSaved results to {}".format(args.save))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
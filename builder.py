@@ -0,0 +1,55 @@
+""" builder.py ================================================================
+Puts our skill together from the handlers and interceptors in skills.py. This
+is kept apart from run.py so the Lambda entry point (lambda_function.py) can
+build the skill without importing Flask.
+=========================================================================== """
+from ask_sdk_core.skill_builder import CustomSkillBuilder
+from ask_sdk_core.api_client import DefaultApiClient
+# from ask_sdk_core.view_resolvers import FileSystemTemplateLoader
+# from ask_sdk_jinja_renderer import JinjaTemplateRenderer
+from skills import (LaunchRequestHandler, GetStationHandler, PlanTripHandler,
+                    SetPreferenceHandler, HelpIntentHandler,
+                    CancelOrStopIntentHandler, FallbackIntentHandler,
+                    SessionEndedRequestHandler, GetAddressExceptionHandler,
+                    DeadlineExceptionHandler, CatchAllExceptionHandler,
+                    TraceRequestInterceptor, TraceResponseInterceptor,
+                    MetricsRequestInterceptor, MetricsResponseInterceptor)
+
+
+def create_skill_builder(api_client=None):
+    """ Builds our skill with all of its handlers and interceptors. The
+        benchmarks (bench.py and coldstart.py) pass in their own api_client. """
+
+    # Initialize our base skill by invoking CustomSkillBuilder.
+    sb = CustomSkillBuilder(api_client=api_client or DefaultApiClient())
+
+    # Register all handlers, interceptors etc. From skills.py.
+    sb.add_request_handler(LaunchRequestHandler())
+    sb.add_request_handler(GetStationHandler())
+    sb.add_request_handler(PlanTripHandler())
+    sb.add_request_handler(SetPreferenceHandler())
+    sb.add_request_handler(HelpIntentHandler())
+    sb.add_request_handler(CancelOrStopIntentHandler())
+    sb.add_request_handler(FallbackIntentHandler())
+    sb.add_request_handler(SessionEndedRequestHandler())
+
+    # Don't forget to add our exception handlers as well.
+    sb.add_exception_handler(GetAddressExceptionHandler())
+    sb.add_exception_handler(DeadlineExceptionHandler())
+    sb.add_exception_handler(CatchAllExceptionHandler())
+
+    # Time every request, and record it under its intent name.
+    sb.add_global_request_interceptor(MetricsRequestInterceptor())
+    sb.add_global_response_interceptor(MetricsResponseInterceptor())
+
+    # Capture a sample of requests and responses so we can look at them later.
+    sb.add_global_request_interceptor(TraceRequestInterceptor())
+    sb.add_global_response_interceptor(TraceResponseInterceptor())
+
+    # Load our Jinja response templates from the templates directory.
+    # sb.add_loaders(FileSystemTemplateLoader(dir_path="templates", encoding='utf-8'))
+
+    # Add default jinja renderer on skill builder.
+    # sb.add_renderer(JinjaTemplateRenderer())
+
+    return sb
@@ -0,0 +1,176 @@
+""" cache.py ==================================================================
+Drivers in the same area tend to ask for the same stations, so there's no
+reason to go back to NREL or Yelp every single time. This file holds a small
+in-memory response cache for our provider lookups.
+
+Lookups are keyed on a geohash of the location, so anyone standing in the same
+cell shares the same entry, plus whatever filter or keyword was used. Each
+cache has a size limit (least recently used entries get evicted first) and a
+time-to-live. Once an entry goes stale we keep serving it for a while longer
+and refresh it in the background, so a busy cell never has to wait on the
+provider. If several requests miss on the same key at once, only one of them
+actually calls the provider and the rest wait for its answer.
+=========================================================================== """
+import threading, time
+from collections import OrderedDict
+from concurrent.futures import Future
+from config import logger, settings
+from pipeline import executor
+
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash(lat, lon, precision=6):
+    """ Encodes a coordinate as a geohash string. Each extra character of
+        precision makes the cell about 4-8 times smaller. """
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        coord, span = (lon, lon_range) if even else (lat, lat_range)
+        mid = (span[0] + span[1]) / 2
+        value <<= 1
+        if coord >= mid:
+            value |= 1
+            span[0] = mid
+        else:
+            span[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits, value = 0, 0
+    return ''.join(chars)
+
+
+def location_key(location, precision=6):
+    """ Coordinates get quantized to a geohash cell, and text addresses get
+        normalized so small differences in spacing or case don't matter. """
+    if type(location) is str:
+        return ' '.join(location.lower().replace(',', ' ').split())
+    return geohash(float(location[0]), float(location[1]), precision)
+
+
+def filter_key(station_filter):
+    """ Turns a filter dict into something hashable and order-independent. """
+    return tuple(sorted((k, str(v).strip().lower()) for k, v in (station_filter or {}).items()))
+
+
+class GeoCache:
+    """ A size-bounded LRU cache with a TTL, stale-while-revalidate, and
+        coalescing of concurrent misses on the same key. """
+
+    def __init__(self, name, ttl=900, stale_ttl=3600, max_size=5000, precision=6):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self.precision = precision
+        self.hits = self.misses = self.stale_hits = self.evictions = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, location, *extra):
+        return (location_key(location, self.precision),) + extra
+
+    def get(self, key, fetch):
+        """ Returns the cached value for key, calling fetch() to fill it in
+            if it's missing or too old. """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                age = now - stored_at
+                if age < self.ttl + self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    if age < self.ttl:
+                        self.hits += 1
+                    else:
+                        # Serve the stale copy now, and refresh it for next time.
+                        self.stale_hits += 1
+                        if key not in self._inflight:
+                            self._inflight[key] = Future()
+                            executor.submit(self._fill, key, fetch)
+                    return value
+
+            self.misses += 1
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._inflight[key] = Future()
+                leader = True
+            else:
+                leader = False
+
+        # Somebody else is already fetching this one, so just wait for them.
+        if not leader:
+            return future.result()
+        return self._fill(key, fetch)
+
+    def _fill(self, key, fetch):
+        future = self._inflight[key]
+        try:
+            value = fetch()
+        except Exception as e:
+            future.set_exception(e)
+            logger.debug("{} cache fill failed: {}".format(self.name, e))
+            raise
+        else:
+            self.put(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def peek(self, key):
+        """ Returns the value for key if we have a fresh copy, or None. This
+            is for batch lookups, where the caller fills in the misses itself. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+def make_cache(name):
+    """ Builds a cache for a provider from the "Cache" block of our config. """
+    config = settings.get('Cache') or {}
+    options = dict(config.get('default') or {}, **(config.get(name) or {}))
+    return GeoCache(name,
+                    ttl=options.get('TTL', 900),
+                    stale_ttl=options.get('STALE_TTL', 3600),
+                    max_size=options.get('MAX_SIZE', 5000),
+                    precision=options.get('PRECISION', 6))
+
+
+# The caches shared by the whole app, one per provider.
+station_cache = make_cache('NREL')
+yelp_cache = make_cache('YELP')
+drive_time_cache = make_cache('HERE')
@@ -0,0 +1,145 @@
+""" coldstart.py ==============================================================
+Measures how long a cold start of the Lambda entry point (lambda_function.py)
+takes. Each run starts a fresh Python process that pretends to be on Lambda,
+and times:
+
+  - import: importing lambda_function.
+  - launch: building the skill and answering a LaunchRequest. Together with
+    the import, this is how long the user waits to hear the welcome message.
+  - lookup imports: the imports the first station lookup pulls in (see
+    skills.py for why those wait).
+  - get station: the first GetStationIntent, against the stubs from bench.py,
+    with nothing cached yet.
+
+    python coldstart.py
+    python coldstart.py --runs 20 --max-import-ms 250
+    python coldstart.py --yaml
+
+The config is precompiled to JSON first, like it would be on Lambda, unless
+you pass --yaml. We print the median of each over all runs, along with the
+modules that take the longest to import, from 'python -X importtime'. Use
+--max-import-ms to fail (exit 1) when the import gets slower than that, say
+as a check before deploying.
+=========================================================================== """
+import argparse, json, os, statistics, subprocess, sys, tempfile, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAUNCH = os.path.join(HERE, 'envelopes', '1-launch.json')
+GET_STATION = os.path.join(HERE, 'envelopes', '3-get-station-geo.json')
+STAGES = ('import', 'launch', 'lookup imports', 'get station')
+
+
+def child():
+    """ Runs inside the fresh process. Prints the timings as JSON. """
+    with open(LAUNCH) as f:
+        launch = json.load(f)
+    with open(GET_STATION) as f:
+        get_station = json.load(f)
+    timings = {}
+
+    started = time.perf_counter()
+    import lambda_function
+    timings['import'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    import utils, ranking, planner, amenities, profiles
+    timings['lookup imports'] = time.perf_counter() - started
+
+    # The stubs need numpy, so they go in after we've timed the imports.
+    from bench import LATENCY, ERRORS, StubApiClient, install_stubs
+    install_stubs(LATENCY, ERRORS, stations=5000)
+
+    started = time.perf_counter()
+    lambda_function.build(StubApiClient(LATENCY['DEVICE'], ERRORS['DEVICE']))
+    response = lambda_function.lambda_handler(launch, None)
+    timings['launch'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    response = lambda_function.lambda_handler(get_station, None)
+    timings['get station'] = time.perf_counter() - started
+
+    speech = response['response'].get('outputSpeech') or {}
+    print(json.dumps({'timings': timings, 'speech': speech.get('ssml')}))
+
+
+def environment(scratch, use_yaml):
+    """ The environment for each fresh process, so it looks like it's on
+        Lambda and keeps its databases out of instance/. """
+    env = dict(os.environ,
+               AWS_LAMBDA_FUNCTION_NAME='waypoint-coldstart',
+               WAYPOINT__Devices__PATH=os.path.join(scratch, 'devices.db'),
+               WAYPOINT__Amenities__PATH=os.path.join(scratch, 'amenities.db'),
+               WAYPOINT__Profiles__PATH=os.path.join(scratch, 'profiles.db'),
+               WAYPOINT__Trace__PATH=os.path.join(scratch, 'trace.jsonl'),
+               WAYPOINT__Index__SNAPSHOT='null',
+               WAYPOINT__Debug__debugMode='false',
+               WAYPOINT__Alexa__SKILL_ID='amzn1.ask.skill.bench')
+    if not use_yaml:
+        from config import load_settings
+        path = os.path.join(scratch, 'config.json')
+        with open(path, 'w') as f:
+            json.dump(load_settings(environ={}), f)
+        env['WAYPOINT_CONFIG'] = path
+    return env
+
+
+def run_once(env):
+    result = subprocess.run([sys.executable, __file__, '--child'], cwd=HERE, env=env,
+                            capture_output=True, text=True)
+    if result.returncode:
+        raise SystemExit("Cold start failed:\n" + result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(env, top):
+    """ The modules that take the longest to import on their own, as
+        [(milliseconds, module), ...]. """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import lambda_function'],
+                            cwd=HERE, env=env, capture_output=True, text=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        modules.append((int(own) / 1000.0, name.strip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time a cold start of the Lambda entry point.")
+    parser.add_argument('-n', '--runs', type=int, default=10)
+    parser.add_argument('--yaml', action='store_true', help="load instance/config.yaml, not JSON")
+    parser.add_argument('--top', type=int, default=15, help="how many of the slowest imports to list")
+    parser.add_argument('--max-import-ms', type=float,
+                        help="exit 1 if the median import takes longer than this")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child()
+
+    env = environment(tempfile.mkdtemp(prefix='waypoint-coldstart-'), args.yaml)
+    runs = [run_once(env) for _ in range(args.runs)]
+    medians = {stage: statistics.median(run['timings'][stage] for run in runs) * 1000
+               for stage in STAGES}
+
+    print("{} cold starts, config from {}:".format(args.runs, 'YAML' if args.yaml else 'JSON'))
+    for stage in STAGES:
+        print("  {:<28}{:>10.1f} ms".format(stage, medians[stage]))
+    print("  {:<28}{:>10.1f} ms".format('first response', medians['import'] + medians['launch']))
+    print("  {:<28}{:>10.1f} ms".format('first station lookup',
+                                        medians['lookup imports'] + medians['get station']))
+    print("\n  Last answer: {}".format(runs[-1]['speech']))
+
+    print("\n  {:<28}{:>10}".format('slowest imports', 'self ms'))
+    for own, name in slowest_imports(env, args.top):
+        print("  {:<28}{:>10.1f}".format(name, own))
+
+    if args.max_import_ms is not None and medians['import'] > args.max_import_ms:
+        print("\nImport took {:.1f} ms, over the limit of {:.1f} ms.".format(
+              medians['import'], args.max_import_ms))
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
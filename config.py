@@ -1,22 +1,93 @@
-import logging, yaml
+""" config.py =================================================================
+Loads our settings and sets up logging. Settings come from
+instance/config.yaml, unless WAYPOINT_CONFIG points somewhere else.
+
+Parsing YAML is slow, so for the Lambda deployment (see lambda_function.py)
+you can precompile the config into a JSON file instead:
+
+    python config.py compile [instance/config.json]
+
+and set WAYPOINT_CONFIG=instance/config.json. Any single setting can also be
+overridden with an environment variable named WAYPOINT__<block>__<key>, such
+as WAYPOINT__NREL__API_KEY. Values are read as JSON where they can be, so
+numbers and true/false come through as such, and as plain text otherwise.
+=========================================================================== """
+import atexit, json, logging, logging.handlers, os, queue, sys
+
+CONFIG_PATH = os.environ.get('WAYPOINT_CONFIG', 'instance/config.yaml')
+ENV_PREFIX = 'WAYPOINT__'
+
+# On Lambda there's nowhere to write a log file, and anything we print to the
+# console ends up in CloudWatch anyway.
+ON_LAMBDA = 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+
+
+def load_settings(path=CONFIG_PATH, environ=os.environ):
+    """ Reads our config file, then applies any environment overrides. """
+    with open(path) as f:
+        if path.endswith('.json'):
+            settings = json.load(f)
+        else:
+            import yaml
+            settings = yaml.load(f, Loader=yaml.FullLoader)
+
+    for name, value in environ.items():
+        if not name.startswith(ENV_PREFIX):
+            continue
+        block, _, key = name[len(ENV_PREFIX):].partition('__')
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        if key:
+            if not isinstance(settings.get(block), dict):
+                settings[block] = {}
+            settings[block][key] = value
+        else:
+            settings[block] = value
+    return settings
+
 
 # Load our local configuration file.
-with open('instance/config.yaml') as f:
-    settings = yaml.load(f, Loader=yaml.FullLoader)
+settings = load_settings()
 
 # It's always good to log things!
+# Outside of debug mode we skip DEBUG messages before they're even formatted.
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+logger.setLevel(logging.DEBUG if settings['Debug']['debugMode'] else logging.INFO)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 
-# Setup our file handler to log messages to file.
-fh = logging.FileHandler('instance/debug.log')
-fh.setLevel(logging.DEBUG)
-fh.setFormatter(formatter)
-logger.addHandler(fh)
-
-# Setup our stream handler to also post messages to console.
+# Setup our stream handler to post messages to console.
 ch = logging.StreamHandler()
 ch.setLevel(logging.DEBUG)
 ch.setFormatter(formatter)
-logger.addHandler(ch)
+
+if ON_LAMBDA:
+    logger.addHandler(ch)
+else:
+    # Setup our file handler to also log messages to file.
+    fh = logging.FileHandler('instance/debug.log')
+    fh.setLevel(logging.DEBUG)
+    fh.setFormatter(formatter)
+
+    # Rather than writing to the file and console on the request thread, we just
+    # drop each log record on a queue. A background thread picks them up and
+    # passes them along to the handlers above.
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, fh, ch, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+
+if __name__ == '__main__':
+    command, args = (sys.argv[1:2] or [''])[0], sys.argv[2:]
+    if command != 'compile':
+        print(__doc__)
+        sys.exit(1)
+
+    path = args[0] if args else os.path.splitext(CONFIG_PATH)[0] + '.json'
+    # Only the file itself goes in, not whatever is in our environment.
+    with open(path, 'w') as f:
+        json.dump(load_settings(environ={}), f, indent=2)
+    print("Wrote {}".format(path))
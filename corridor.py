@@ -0,0 +1,93 @@
+""" corridor.py ===============================================================
+Geometry helpers for finding stations along a route, rather than around a
+single point. A route comes in as a polyline: a list of (lat, long) points.
+
+Routes from a navigation system can have thousands of points, most of which
+only bend the line by a few feet. So we first simplify the route with the
+Douglas-Peucker algorithm, which keeps the overall shape to within a set
+tolerance using a small fraction of the points. Then we chop the route into
+short pieces, and only check each station against the pieces near it.
+
+Distances are worked out on a flat "local" projection, measured in miles. That
+is plenty accurate over the few miles we care about around a route.
+=========================================================================== """
+import math
+
+
+MILES_PER_DEGREE = 69.0
+
+
+def project(lat, lon, cos_lat):
+    """ Flattens a coordinate onto a plane measured in miles. """
+    return (lon * MILES_PER_DEGREE * cos_lat, lat * MILES_PER_DEGREE)
+
+
+def point_segment(px, py, ax, ay, bx, by):
+    """ Returns (distance, t) from point p to segment a-b, where t is how far
+        along the segment (0 to 1) the closest point is. """
+    dx, dy = bx - ax, by - ay
+    length2 = dx * dx + dy * dy
+    t = 0.0 if length2 == 0 else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length2))
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy)), t
+
+
+def simplify(polyline, tolerance=0.1):
+    """ Douglas-Peucker simplification. Drops points until the line would move
+        more than 'tolerance' miles. Uses a stack instead of recursion, since
+        long routes can be deep. """
+    points = [(float(lat), float(lon)) for lat, lon in polyline]
+    if len(points) < 3:
+        return points
+
+    cos_lat = math.cos(math.radians(sum(p[0] for p in points) / len(points)))
+    flat = [project(lat, lon, cos_lat) for lat, lon in points]
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay = flat[first]
+        bx, by = flat[last]
+        furthest, index = 0.0, None
+        for i in range(first + 1, last):
+            distance, _ = point_segment(flat[i][0], flat[i][1], ax, ay, bx, by)
+            if distance > furthest:
+                furthest, index = distance, i
+        if index is not None and furthest > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def split_segments(polyline, max_length):
+    """ Breaks a route into segments no longer than max_length miles. Each one
+        is returned as (start, end, miles_along_route_at_start). """
+    segments, along = [], 0.0
+    for (lat1, lon1), (lat2, lon2) in zip(polyline, polyline[1:]):
+        cos_lat = math.cos(math.radians((lat1 + lat2) / 2))
+        ax, ay = project(lat1, lon1, cos_lat)
+        bx, by = project(lat2, lon2, cos_lat)
+        length = math.hypot(bx - ax, by - ay)
+        pieces = max(1, int(math.ceil(length / max_length)))
+        for k in range(pieces):
+            f1, f2 = k / pieces, (k + 1) / pieces
+            start = (lat1 + (lat2 - lat1) * f1, lon1 + (lon2 - lon1) * f1)
+            end = (lat1 + (lat2 - lat1) * f2, lon1 + (lon2 - lon1) * f2)
+            segments.append((start, end, along + length * f1))
+        along += length
+    return segments
+
+
+def offset_from_segment(lat, lon, segment):
+    """ Returns (miles off the route, miles along the route) for a point,
+        measured against a single segment. """
+    (lat1, lon1), (lat2, lon2), along = segment
+    cos_lat = math.cos(math.radians((lat1 + lat2) / 2))
+    ax, ay = project(lat1, lon1, cos_lat)
+    bx, by = project(lat2, lon2, cos_lat)
+    px, py = project(lat, lon, cos_lat)
+    distance, t = point_segment(px, py, ax, ay, bx, by)
+    return distance, along + t * math.hypot(bx - ax, by - ay)
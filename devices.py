@@ -0,0 +1,88 @@
+""" devices.py ================================================================
+When a device can't give us its geolocation, we fall back to the address the
+user registered for it, which means a call to the Device Address API and then
+another call to turn that address into coordinates. An Echo sitting in
+someone's kitchen doesn't move very often, so we remember the answer here.
+
+Resolved coordinates are saved to a small SQLite database, keyed by device id,
+so they survive restarts and are shared by every worker on the box. The most
+recently used devices are also kept in memory, so most lookups never touch
+the database at all. Entries expire after TTL seconds, in case someone moves.
+=========================================================================== """
+import sqlite3, threading, time
+from collections import OrderedDict
+from config import logger, settings
+
+
+class DeviceLocationStore:
+    """ A persistent device id -> (lat, long) cache, with an LRU in front. """
+
+    def __init__(self, path, ttl=604800, front_size=1000):
+        self.path = path
+        self.ttl = ttl
+        self.front_size = front_size
+        self._front = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS devices ("
+                         "device_id TEXT PRIMARY KEY, "
+                         "latitude REAL NOT NULL, "
+                         "longitude REAL NOT NULL, "
+                         "address TEXT, "
+                         "updated_at REAL NOT NULL)")
+        self._db.commit()
+
+    def get(self, device_id):
+        """ Returns the saved (lat, long) for a device, or None. """
+        now = time.time()
+        with self._lock:
+            entry = self._front.get(device_id)
+            if entry is None:
+                entry = self._db.execute("SELECT latitude, longitude, updated_at FROM devices "
+                                         "WHERE device_id = ?", (device_id,)).fetchone()
+                if entry is None:
+                    return None
+                entry = ((entry[0], entry[1]), entry[2])
+                self._remember(device_id, entry)
+            else:
+                self._front.move_to_end(device_id)
+
+        location, updated_at = entry
+        if now - updated_at > self.ttl:
+            logger.debug("Saved location for this device has expired.")
+            return None
+        return location
+
+    def put(self, device_id, location, address=None):
+        """ Saves the resolved coordinates for a device. """
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?)",
+                             (device_id, location[0], location[1], address, now))
+            self._db.commit()
+            self._remember(device_id, (tuple(location), now))
+
+    def forget(self, device_id):
+        with self._lock:
+            self._front.pop(device_id, None)
+            self._db.execute("DELETE FROM devices WHERE device_id = ?", (device_id,))
+            self._db.commit()
+
+    def _remember(self, device_id, entry):
+        self._front[device_id] = entry
+        self._front.move_to_end(device_id)
+        while len(self._front) > self.front_size:
+            self._front.popitem(last=False)
+
+
+def make_device_store():
+    """ Builds our device store from the "Devices" block of our config. """
+    config = settings.get('Devices') or {}
+    return DeviceLocationStore(config.get('PATH', 'instance/devices.db'),
+                               ttl=config.get('TTL', 604800),
+                               front_size=config.get('FRONT_SIZE', 1000))
+
+
+# This is the device store shared by the whole app.
+device_locations = make_device_store()
@@ -0,0 +1,290 @@
+""" index.py ==================================================================
+This file keeps a local copy of the NREL charging station database in memory,
+so that we don't have to call their API every time a user asks for a station.
+
+Stations are bucketed into a simple lat/long grid. To find the nearest stations
+we search the grid cell the user is in, then work our way outwards ring by ring
+until we're sure nothing closer is left. The index reloads itself in the
+background whenever NREL reports that their dataset has changed.
+
+If a station snapshot is set in our config (see snapshot.py), we memory-map
+that file instead of downloading from NREL, and reload it whenever the file
+is replaced with a new generation.
+=========================================================================== """
+import math, os, threading, time
+from array import array
+from config import logger, settings
+from corridor import simplify, split_segments, offset_from_segment
+from models import Station, StationList
+from snapshot import Snapshot
+from providers import get_client
+
+
+# Mean radius of the earth, in miles (NREL reports distances in miles).
+EARTH_RADIUS = 3958.8
+
+# Roughly how many miles are in one degree of latitude.
+MILES_PER_DEGREE = 69.0
+
+# NREL uses a 5 mile radius when one isn't given, so we do the same. An
+# "infinite" radius still needs a cap, otherwise an empty area would make us
+# scan the entire grid.
+DEFAULT_RADIUS = 5.0
+MAX_RADIUS = 500.0
+DEFAULT_LIMIT = 20
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """ Great-circle distance between two points, in miles. """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def _split(value):
+    """ NREL accepts comma separated lists for most of its filters. """
+    if value is None:
+        return None
+    values = {v.strip().upper() for v in str(value).split(',') if v.strip()}
+    return None if not values or 'ALL' in values else values
+
+
+def match_filter(station, station_filter):
+    """ Check a station against the same filter we would send to NREL. """
+    pricing = station_filter.get('ev_pricing')
+    if pricing and pricing.lower() not in (station.ev_pricing or '').lower():
+        return False
+
+    networks = _split(station_filter.get('ev_network'))
+    if networks and (station.ev_network or '').upper() not in networks:
+        return False
+
+    connectors = _split(station_filter.get('ev_connector_type'))
+    if connectors:
+        station_connectors = {c.upper() for c in station.ev_connector_types or []}
+        if not connectors & station_connectors:
+            return False
+
+    return True
+
+
+class StationIndex:
+    """ Grid-bucketed, in-memory index of charging stations. """
+
+    def __init__(self, cell_size=0.25):
+        self.cell_size = cell_size
+        self.updated_at = None
+        self.snapshot = None
+        # Everything a query needs lives in this one tuple, so a reload can
+        # swap it out in a single assignment without locking out readers.
+        self._data = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self._data is not None
+
+    def __len__(self):
+        return len(self._data[0]) if self._data else 0
+
+    def cell(self, lat, lon):
+        """ Returns the grid cell that a coordinate falls into. """
+        return (math.floor(lat / self.cell_size), math.floor(lon / self.cell_size))
+
+    def load(self, stations, updated_at=None):
+        """ Build a fresh grid from a list of stations (or raw NREL station
+            dicts), then swap it in place of the current one. """
+        records, lats, lons, cells = [], array('d'), array('d'), {}
+        for station in stations:
+            if isinstance(station, dict):
+                station = Station.from_dict(station)
+            lat, lon = station.latitude, station.longitude
+            if lat is None or lon is None:
+                continue
+            cells.setdefault(self.cell(lat, lon), array('I')).append(len(records))
+            records.append(station)
+            lats.append(lat)
+            lons.append(lon)
+
+        self._data = (records, lats, lons, cells)
+        self.updated_at = updated_at
+        logger.debug("Station index loaded with {} stations in {} cells.".format(
+                     len(records), len(cells)))
+
+    def load_snapshot(self, snapshot):
+        """ Point the index at a memory-mapped Snapshot. The snapshot already
+            has its stations sorted into cells, so there's nothing to build. """
+        self.cell_size = snapshot.cell_size
+        self._data = (snapshot, snapshot.lats, snapshot.lons, snapshot.cells())
+        self.updated_at = snapshot.generation
+        self.snapshot = snapshot
+        logger.debug("Station index mapped {} stations from snapshot generation {}.".format(
+                     len(snapshot), snapshot.generation))
+
+    def nearest(self, location, station_filter=None, limit=None, radius=None):
+        """ Returns a StationList of stations matching the filter, sorted by
+            distance, the same as we'd get back from their nearest.json. """
+        station_filter = station_filter or {}
+        data = self._data
+        if data is None:
+            return None
+        records, lats, lons, cells = data
+
+        lat, lon = float(location[0]), float(location[1])
+        limit = int(limit or station_filter.get('limit') or DEFAULT_LIMIT)
+        radius = radius or station_filter.get('radius') or DEFAULT_RADIUS
+        radius = MAX_RADIUS if radius == 'infinite' else min(float(radius), MAX_RADIUS)
+
+        # Longitude cells get narrower the further we are from the equator,
+        # so this gives us a safe lower bound on how far away each ring is.
+        ring_width = self.cell_size * MILES_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01)
+        max_ring = int(radius / ring_width) + 1
+        center_i, center_j = self.cell(lat, lon)
+
+        found = []
+        for ring in range(max_ring + 1):
+            # Once we have enough stations and the next ring can't possibly
+            # have anything closer, we're done.
+            if len(found) >= limit and found[limit - 1][0] <= (ring - 1) * ring_width:
+                break
+            for key in self._ring(center_i, center_j, ring):
+                for row in cells.get(key, ()):
+                    distance = haversine(lat, lon, lats[row], lons[row])
+                    if distance <= radius and match_filter(records[row], station_filter):
+                        found.append((distance, row))
+            found.sort()
+
+        return StationList(records[row].with_distance(distance) for distance, row in found[:limit])
+
+    def along_route(self, polyline, miles=None, station_filter=None, limit=None, tolerance=None):
+        """ Finds stations within 'miles' of a route, given as a list of
+            (lat, long) points. Returns a list of (station, detour, along)
+            tuples, cheapest detour first. 'detour' is the extra miles to get
+            to the station and back to the route (as the crow flies), 'along'
+            is how far down the route you'd turn off, and each station's
+            distance is how far it sits from the route. """
+        data = self._data
+        if data is None:
+            return None
+        records, lats, lons, cells = data
+        station_filter = station_filter or {}
+        miles = float(miles or settings['Index'].get('ROUTE_MILES', 2.0))
+        tolerance = tolerance or settings['Index'].get('ROUTE_TOLERANCE', 0.1)
+        limit = int(limit or station_filter.get('limit') or DEFAULT_LIMIT)
+
+        route = simplify(polyline, tolerance)
+        if len(route) == 1:
+            route = route * 2
+        segments = split_segments(route, self.cell_size * MILES_PER_DEGREE)
+
+        # Work out which pieces of the route pass near each grid cell, so
+        # each station only gets measured against the pieces close to it.
+        near = {}
+        for n, ((lat1, lon1), (lat2, lon2), _) in enumerate(segments):
+            cos_lat = max(math.cos(math.radians(max(abs(lat1), abs(lat2)))), 0.01)
+            pad_lat = miles / MILES_PER_DEGREE
+            pad_lon = miles / (MILES_PER_DEGREE * cos_lat)
+            i1, j1 = self.cell(min(lat1, lat2) - pad_lat, min(lon1, lon2) - pad_lon)
+            i2, j2 = self.cell(max(lat1, lat2) + pad_lat, max(lon1, lon2) + pad_lon)
+            for i in range(i1, i2 + 1):
+                for j in range(j1, j2 + 1):
+                    near.setdefault((i, j), []).append(n)
+
+        best = {}
+        for key, pieces in near.items():
+            for row in cells.get(key, ()):
+                for n in pieces:
+                    offset, along = offset_from_segment(lats[row], lons[row], segments[n])
+                    if offset <= miles and (row not in best or offset < best[row][0]):
+                        best[row] = (offset, along)
+
+        found = sorted((offset, along, row) for row, (offset, along) in best.items()
+                       if match_filter(records[row], station_filter))
+        return [(records[row].with_distance(offset), 2 * offset, along)
+                for offset, along, row in found[:limit]]
+
+    @staticmethod
+    def _ring(i, j, ring):
+        """ Yields the grid cells that sit exactly 'ring' cells away. """
+        if ring == 0:
+            yield (i, j)
+            return
+        for dj in range(-ring, ring + 1):
+            yield (i - ring, j + dj)
+            yield (i + ring, j + dj)
+        for di in range(-ring + 1, ring):
+            yield (i + di, j - ring)
+            yield (i + di, j + ring)
+
+    def start(self):
+        """ Loads the index and keeps it fresh from a background thread.
+            Queries fall back to the live API until the first load is done. """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        if settings['Index'].get('SNAPSHOT'):
+            return self._watch_snapshot(settings['Index']['SNAPSHOT'])
+        interval = settings['Index'].get('REFRESH_INTERVAL', 3600)
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning("Station index refresh failed: {}".format(e))
+            time.sleep(interval)
+
+    def _watch_snapshot(self, path):
+        """ Maps the snapshot file, then keeps checking whether it has been
+            swapped out for a new one. Checking is just a stat() call. """
+        interval = settings['Index'].get('SNAPSHOT_CHECK', 30)
+        while True:
+            try:
+                if self.snapshot is None or self.snapshot.changed():
+                    if os.path.exists(path):
+                        self.load_snapshot(Snapshot(path))
+                    else:
+                        logger.warning("Station snapshot {} not found.".format(path))
+            except Exception as e:
+                logger.warning("Failed to load station snapshot: {}".format(e))
+            time.sleep(interval)
+
+    def refresh(self):
+        """ Reload the dataset if NREL says it has changed since our last load. """
+        updated_at = fetch_last_updated()
+        if self.ready and updated_at and updated_at == self.updated_at:
+            logger.debug("Station index is up to date.")
+            return False
+        self.load(fetch_all_stations(), updated_at)
+        return True
+
+
+def fetch_all_stations():
+    """ Downloads every public, open, electric station from NREL. """
+    PARAMS = {'api_key': settings['NREL']['API_KEY'],
+              'fuel_type': 'ELEC',
+              'status': 'E',
+              'access': 'public',
+              'limit': 'all'}
+    # The full dataset is big, so give it much longer to download, and time to
+    # retry. It gets a client (and circuit breaker) of its own, so a slow
+    # download can't trip the breaker that live lookups depend on.
+    client = get_client('NREL_BULK')
+    bulk_timeout = settings['Index'].get('BULK_TIMEOUT', 120)
+    timeout = (client.timeout[0], bulk_timeout)
+    budget = settings['Index'].get('BULK_BUDGET', bulk_timeout * (client.options['RETRIES'] + 1))
+    return client.get(settings['Index']['BULK_URL'], PARAMS, timeout, StationList.from_json,
+                      budget=budget)
+
+
+def fetch_last_updated():
+    """ Asks NREL when their station dataset was last changed. """
+    PARAMS = {'api_key': settings['NREL']['API_KEY']}
+    return get_client('NREL').get(settings['Index']['UPDATED_URL'], PARAMS).get('last_updated')
+
+
+# This is the index shared by the whole app.
+station_index = StationIndex(settings['Index'].get('CELL_SIZE', 0.25))
@@ -0,0 +1,52 @@
+""" lambda_function.py ========================================================
+The entry point for running our skill on Amazon's lambda host service, instead
+of behind Flask (see run.py). Point the function's handler at
+lambda_function.lambda_handler.
+
+Every time Lambda starts a fresh copy of us (a cold start), the user waits on
+all of our imports before hearing anything. So this file keeps that as short
+as it can:
+
+  - Flask isn't imported at all, only the skill itself (see builder.py).
+  - The station lookup's imports (numpy, SQLite, provider clients) wait until
+    the first request that needs them (see skills.py).
+  - The config can be precompiled to JSON, which skips loading YAML:
+
+        python config.py compile instance/config.json
+
+    then set WAYPOINT_CONFIG=instance/config.json on the function.
+
+Only /tmp is writable on Lambda, so point the databases there with
+environment overrides, e.g. WAYPOINT__Devices__PATH=/tmp/devices.db,
+WAYPOINT__Amenities__PATH=/tmp/amenities.db and
+WAYPOINT__Profiles__PATH=/tmp/profiles.db. The trace writer, the station index
+and the profile writer aren't started here. So station lookups go to NREL
+(through our caches), and profile changes are saved as soon as they're made.
+Prefetching is off on Lambda too (see skills.py).
+
+To see how long a cold start takes, run coldstart.py.
+=========================================================================== """
+from config import settings
+from builder import create_skill_builder
+
+
+# This is the unique ID of our skill, found in the alexa developer console.
+SKILL_ID = settings['Alexa']['SKILL_ID']
+
+# Built on the first request rather than at import, so the import itself stays
+# cheap and coldstart.py can swap in its own api_client.
+handler = None
+
+
+def build(api_client=None):
+    """ Puts the skill together. Only the first call does anything. """
+    global handler
+    if handler is None:
+        sb = create_skill_builder(api_client)
+        sb.skill_id = SKILL_ID
+        handler = sb.lambda_handler()
+    return handler
+
+
+def lambda_handler(event, context):
+    return build()(event, context)
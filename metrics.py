@@ -0,0 +1,141 @@
+""" metrics.py ================================================================
+Lightweight, in-process latency metrics. Wrap any piece of work in a span:
+
+    with metrics.span('stage.stations'):
+        station_list = get_station_list(location, station_filter)
+
+and its duration is added to a histogram under that name. Spans that raise an
+exception also bump an error counter, or a timeout counter for timeouts. We
+use names like 'intent.GetStationIntent', 'stage.location' and 'provider.NREL'.
+
+Histograms use fixed, log-spaced buckets, so recording a value is just a
+bisect and a couple of additions, cheap enough to leave on all the time. The
+percentiles we report are the upper edge of the bucket they land in, which is
+within about 20% of the true value. Everything can be read back with
+metrics.report(), which is what the /metrics route returns.
+=========================================================================== """
+import threading, time
+from bisect import bisect_left
+from concurrent.futures import TimeoutError as FutureTimeout
+
+
+# Bucket edges in seconds, from half a millisecond up to about a minute.
+BUCKETS = [0.0005 * 1.2 ** k for k in range(65)]
+
+PERCENTILES = (50, 95, 99)
+
+
+def _is_timeout(exception):
+    """ Anything that looks like a timeout: futures, sockets, requests, or our
+        own DeadlineExceeded. We go by name to avoid importing all of them. """
+    if isinstance(exception, (TimeoutError, FutureTimeout)):
+        return True
+    return any('Timeout' in cls.__name__ or 'Deadline' in cls.__name__
+               for cls in type(exception).__mro__)
+
+
+class Histogram:
+    """ A fixed-bucket latency histogram with error and timeout counters. """
+
+    __slots__ = ('counts', 'count', 'total', 'max', 'errors', 'timeouts')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+        self.timeouts = 0
+
+    def record(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """ Upper edge of the bucket that the p-th percentile falls into. """
+        if not self.count:
+            return None
+        target, seen = self.count * p / 100.0, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def summary(self):
+        summary = {'count': self.count,
+                   'errors': self.errors,
+                   'timeouts': self.timeouts,
+                   'mean_ms': round(1000 * self.total / self.count, 3) if self.count else None,
+                   'max_ms': round(1000 * self.max, 3)}
+        for p in PERCENTILES:
+            value = self.percentile(p)
+            summary['p{}_ms'.format(p)] = round(1000 * value, 3) if value is not None else None
+        return summary
+
+
+class Span:
+    """ Times a block of work and records it when the block exits. """
+
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.record(self.name, time.perf_counter() - self.start, exc)
+        return False
+
+
+class Metrics:
+    """ A registry of named histograms. """
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def span(self, name):
+        return Span(self, name)
+
+    def _get(self, name):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram()
+        return histogram
+
+    def record(self, name, seconds, exception=None):
+        with self._lock:
+            histogram = self._get(name)
+            histogram.record(seconds)
+            if exception is not None:
+                if _is_timeout(exception):
+                    histogram.timeouts += 1
+                else:
+                    histogram.errors += 1
+
+    def timeout(self, name):
+        """ Counts a timeout that was handled inside a span (say, one that we
+            retried), without recording a latency for it. """
+        with self._lock:
+            self._get(name).timeouts += 1
+
+    def report(self):
+        """ Returns every histogram's summary, keyed by name. """
+        with self._lock:
+            return {name: h.summary() for name, h in sorted(self._histograms.items())}
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+# This is the metrics registry shared by the whole app.
+metrics = Metrics()
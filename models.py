@@ -1,8 +1,100 @@
 """ models.py =================================================================
 Some of the .json responses we deal with can be complex and may be better suited
-to be registered into a class object. In the future, if we need to build a class
-model for our data, then we'll put them in here.
+to be registered into a class object. This is where those class models live.
+
+NREL sends back dozens of fields for every station, and we only use a handful
+of them. Rather than holding on to the whole decoded response, we pick out the
+fields we need while the JSON is being decoded, and store them in a compact
+Station record. The rest of each station's dict is thrown away right away.
 =========================================================================== """
+import json
+
+
+class Station:
+    """ A single charging station, holding only the NREL fields we use. """
+
+    # These are the NREL field names we keep, in the same spelling they use.
+    FIELDS = ('id', 'station_name', 'street_address', 'city', 'state', 'zip',
+              'latitude', 'longitude', 'ev_network', 'ev_pricing',
+              'ev_connector_types', 'ev_level1_evse_num', 'ev_level2_evse_num',
+              'ev_dc_fast_num', 'access_days_time')
+
+    __slots__ = FIELDS + ('distance',)
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    def __repr__(self):
+        return "Station({!r}, {!r})".format(self.id, self.station_name)
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Builds a Station from a decoded NREL station dict. """
+        station = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(station, name, data.get(name))
+        return station
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def with_distance(self, distance):
+        """ Returns a copy of this station with its distance filled in. """
+        station = Station.__new__(Station)
+        for name in self.FIELDS:
+            setattr(station, name, getattr(self, name))
+        station.distance = distance
+        return station
+
+    @property
+    def location(self):
+        return (self.latitude, self.longitude)
+
+    @property
+    def address(self):
+        """ A one-line street address, handy for speech and other APIs. """
+        return "{}, {}, {} {}".format(self.street_address, self.city, self.state, self.zip)
+
+    @property
+    def network(self):
+        """ The network name, or an empty string for non-networked stations. """
+        network = self.ev_network or ""
+        return "" if "Non" in network else network
+
+
+def _station_hook(data):
+    """ Called by the JSON decoder for every object in the response. Anything
+        that looks like a station gets trimmed down into a Station record. """
+    if 'fuel_type_code' in data and 'latitude' in data:
+        return Station.from_dict(data)
+    return data
+
+
+class StationList:
+    """ A list of stations returned from a query, sorted by distance. """
+
+    __slots__ = ('stations', 'total_results')
+
+    def __init__(self, stations, total_results=None):
+        self.stations = list(stations)
+        self.total_results = len(self.stations) if total_results is None else total_results
+
+    def __len__(self):
+        return len(self.stations)
+
+    def __iter__(self):
+        return iter(self.stations)
+
+    def __getitem__(self, index):
+        return self.stations[index]
+
+    @classmethod
+    def from_json(cls, content):
+        """ Decodes an NREL response (as bytes or text) into a StationList. """
+        data = json.loads(content, object_hook=_station_hook)
+        return cls(data.get('fuel_stations') or [], data.get('total_results'))
 
-# class ev_station(self, json):
-#    name = self.name
+    def to_dict(self):
+        return {'fuel_stations': [station.to_dict() for station in self.stations],
+                'total_results': self.total_results}
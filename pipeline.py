@@ -0,0 +1,112 @@
+""" pipeline.py ===============================================================
+Alexa will give up on our skill if we take longer than about 8 seconds to send
+back a response. This file gives our handlers a shared thread pool, so that
+slow provider calls can run side by side, and a Deadline object that keeps the
+whole request inside one time budget.
+
+    with Deadline(5.0) as deadline:
+        a = deadline.submit(get_station_list, location, station_filter)
+        b = deadline.submit(get_yelp_results, address, keyword)
+        stations, places = deadline.result(a), deadline.result(b)
+
+Anything still waiting in the queue when the deadline runs out (or when the
+with block exits) gets cancelled. Python can't interrupt a thread that is
+already running, so calls that have started will finish in the background,
+but we stop waiting on them. To keep those from tying up a worker for long,
+tasks can call time_left() to find out how much of the budget they have, and
+our provider clients cut their timeouts and retries short to fit it (see
+providers.py).
+=========================================================================== """
+import threading, time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from config import logger, settings
+
+
+# One pool is shared by every request, so it also caps how many upstream
+# calls we can have in flight at the same time.
+executor = ThreadPoolExecutor(max_workers=settings['Pipeline'].get('WORKERS', 16),
+                              thread_name_prefix='pipeline')
+
+
+# Fire-and-forget extras (like progressive responses) get a small pool of
+# their own, so they never hold up the lookups a request is waiting on.
+background = ThreadPoolExecutor(max_workers=settings['Pipeline'].get('BACKGROUND_WORKERS', 4),
+                                thread_name_prefix='background')
+
+
+# The deadline of whatever task the current thread is running, if any.
+_current = threading.local()
+
+
+def time_left():
+    """ Seconds left in the budget of the task running on this thread, or
+        None if it isn't running under a Deadline. """
+    expires = getattr(_current, 'expires', None)
+    return None if expires is None else max(0.0, expires - time.monotonic())
+
+
+class DeadlineExceeded(Exception):
+    """ Raised when a task didn't finish inside the request's time budget. """
+
+
+class Deadline:
+    """ A time budget for a single request, plus the tasks running under it. """
+
+    def __init__(self, budget=None):
+        budget = settings['Pipeline'].get('DEADLINE', 7.0) if budget is None else budget
+        self.expires = time.monotonic() + budget
+        self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cancel()
+        return False
+
+    @property
+    def remaining(self):
+        """ Seconds left in the budget, never less than zero. """
+        return max(0.0, self.expires - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining <= 0
+
+    def submit(self, fn, *args, **kwargs):
+        """ Start a task on the shared pool and track it under this deadline. """
+        if self.expired:
+            raise DeadlineExceeded("No time left to start {}".format(fn.__name__))
+        future = executor.submit(self._run, fn, args, kwargs)
+        self.futures.append(future)
+        return future
+
+    def _run(self, fn, args, kwargs):
+        # Runs on the worker thread, so time_left() knows our budget.
+        _current.expires = self.expires
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.expires = None
+
+    def background(self, fn, *args, **kwargs):
+        """ Start a task we won't wait for on the background pool. It still
+            gets cancelled if it hasn't started by the time we're done. """
+        future = background.submit(fn, *args, **kwargs)
+        self.futures.append(future)
+        return future
+
+    def result(self, future):
+        """ Wait for a task, but only as long as our budget allows. Errors
+            raised by the task itself are passed through to the caller. """
+        try:
+            return future.result(timeout=self.remaining)
+        except TimeoutError:
+            future.cancel()
+            raise DeadlineExceeded("Task did not finish before the deadline.")
+
+    def cancel(self):
+        """ Cancel anything that hasn't started running yet. """
+        cancelled = sum(1 for future in self.futures if future.cancel())
+        if cancelled:
+            logger.debug("Cancelled {} pending tasks.".format(cancelled))
@@ -0,0 +1,382 @@
+""" planner.py ================================================================
+Works out where a car can get to on the charge it has left, and plans the
+charging stops for trips that are too long to make in one go.
+
+The car is described by a Vehicle: its range and battery size, the connectors
+it takes, and how fast it can charge. Users can tell us which car they drive
+(see profiles.py). If it's one listed under "Vehicles" in instance/config.yaml
+we use that, and otherwise the one under "Vehicle".
+
+For longer trips we search a graph of charging stations. Each station is a
+node, joined to other stations that a car could plausibly drive to between
+charges. Working out those hops is far too slow to do while someone waits, so
+the graph is built ahead of time, and saved next to the station snapshot:
+
+    python planner.py build [graph path]
+
+A station within range of everything would end up with thousands of
+neighbours. So, for each station, we split the area around it into compass
+sectors and distance bands, and only keep the furthest few stations in each
+one. That's plenty to get anywhere, and it keeps the graph small.
+
+At request time, planning a trip is an A* search over that graph. A leg costs
+the time spent driving it, plus the time spent charging for it at the station
+you leave from (we charge just enough for the next leg, on top of the
+reserve), plus a few minutes for making the stop at all. A station's DC fast
+chargers only count if one of them takes the car's plug. If none do, we
+charge there at AC speeds, if we can plug in at all.
+
+No routing calls are made. Distances are straight-line miles times
+ROAD_FACTOR, which is close enough for deciding where to stop.
+=========================================================================== """
+import heapq, math, os, sys, threading, time
+import numpy as np
+from config import logger, settings
+from models import Station
+from index import haversine
+from ranking import haversine_many
+from snapshot import CONNECTORS
+
+
+# Roughly how many kW each kind of port delivers.
+LEVEL1_KW = 1.4
+LEVEL2_KW = 7.2
+
+# The plugs that DC fast chargers use. A station's DC ports are only any use
+# to a car that takes one of the same plugs. Otherwise it charges on AC there.
+DC_CONNECTORS = ('CHADEMO', 'J1772COMBO', 'TESLA')
+
+# How many sectors we split the area around each station into.
+SECTORS = 8
+
+TEXT_FIELDS = ('station_name', 'city', 'state')
+
+
+class Vehicle:
+    """ The car we're planning for. Ranges are in miles, energy in kWh and
+        charging power in kW. Charge levels are fractions of a full battery. """
+
+    def __init__(self, name, range, battery, connectors=None, max_ac=6.6, max_dc=50.0,
+                 reserve=0.1, charge=0.5):
+        self.name = name
+        self.range = range
+        self.battery = battery
+        self.connectors = [c.upper() for c in connectors or []]
+        self.max_ac = max_ac
+        self.max_dc = max_dc
+        self.reserve = reserve
+        # How full the battery is, when nobody has told us.
+        self.charge = charge
+
+    @property
+    def miles_per_kwh(self):
+        return self.range / self.battery
+
+    def range_at(self, charge):
+        """ How far we can drive, leaving the reserve untouched. """
+        return max(0.0, self.range * (charge - self.reserve))
+
+    def takes_dc(self, connectors):
+        """ True if we can plug into a station's DC fast chargers, given the
+            connectors it has. If we don't know our own plugs, assume we can. """
+        if not self.connectors:
+            return True
+        return any(c.upper() in DC_CONNECTORS and c.upper() in self.connectors
+                   for c in connectors or [])
+
+    def charge_rate(self, level1=0, level2=0, dc_fast=0, connectors=None):
+        """ The best charging power we'd get from a station's ports. """
+        if dc_fast and self.max_dc and self.takes_dc(connectors):
+            return self.max_dc
+        if level2:
+            return min(self.max_ac, LEVEL2_KW)
+        if level1:
+            return min(self.max_ac, LEVEL1_KW)
+        return 0.0
+
+    def charge_hours(self, station, start, target):
+        """ How long it takes to charge from 'start' to 'target' at a station. """
+        rate = self.charge_rate(station.ev_level1_evse_num, station.ev_level2_evse_num,
+                                station.ev_dc_fast_num, station.ev_connector_types)
+        if target <= start:
+            return 0.0
+        return self.battery * (target - start) / rate if rate else None
+
+
+def make_vehicle(config=None):
+    """ Builds a Vehicle from the "Vehicle" block of our config. """
+    config = config or settings.get('Vehicle') or {}
+    return Vehicle(config.get('NAME', 'Nissan Leaf'),
+                   range=config.get('RANGE', 200),
+                   battery=config.get('BATTERY', 60),
+                   connectors=config.get('CONNECTORS'),
+                   max_ac=config.get('MAX_AC', 6.6),
+                   max_dc=config.get('MAX_DC', 50.0),
+                   reserve=config.get('RESERVE', 0.1),
+                   charge=config.get('CHARGE', 0.5))
+
+
+def road_miles(miles):
+    """ Turns a straight-line distance into a rough driving distance. """
+    return miles * settings['Planner'].get('ROAD_FACTOR', 1.25)
+
+
+def reachable_miles(vehicle, charge):
+    """ The furthest (straight-line) distance a station can be for us to make
+        it there on our current charge. """
+    return vehicle.range_at(charge) / settings['Planner'].get('ROAD_FACTOR', 1.25)
+
+
+def build_graph(stations, path, max_hop=300.0, band=50.0, per_cell=2, dc_fast_only=True):
+    """ Builds the station graph and saves it to path. Hops are stored as
+        driving miles. The file is swapped in atomically, like a snapshot. """
+    stations = [Station.from_dict(s) if isinstance(s, dict) else s for s in stations]
+    stations = [s for s in stations if s.latitude is not None and s.longitude is not None
+                and (s.ev_dc_fast_num or not dc_fast_only)]
+    n = len(stations)
+    lats = np.array([s.latitude for s in stations], dtype=float)
+    lons = np.array([s.longitude for s in stations], dtype=float)
+    bands = int(math.ceil(max_hop / band))
+
+    indptr, indices, miles = [0], [], []
+    for i in range(n):
+        distance = road_miles(haversine_many(lats[i], lons[i], lats, lons))
+        near = np.nonzero((distance > 0) & (distance <= max_hop))[0]
+        if len(near):
+            # Which sector and band each neighbour falls in.
+            bearing = np.arctan2((lons[near] - lons[i]) * math.cos(math.radians(lats[i])),
+                                 lats[near] - lats[i])
+            sector = ((bearing + math.pi) / (2 * math.pi) * SECTORS).astype(int) % SECTORS
+            cell = sector * bands + np.minimum((distance[near] / band).astype(int), bands - 1)
+            # Sort by cell, furthest first, then keep the first few of each cell.
+            order = np.lexsort((-distance[near], cell))
+            cell = cell[order]
+            starts = np.searchsorted(cell, cell, side='left')
+            keep = near[order][np.arange(len(cell)) - starts < per_cell]
+            indices.extend(keep.tolist())
+            miles.extend(distance[keep].tolist())
+        indptr.append(len(indices))
+
+    flags = []
+    for s in stations:
+        bits = 0
+        for c in s.ev_connector_types or []:
+            if c.upper() in CONNECTORS:
+                bits |= 1 << CONNECTORS.index(c.upper())
+        flags.append(bits)
+
+    arrays = {'ids': np.array([int(s.id or 0) for s in stations], dtype=np.uint32),
+              'lats': lats, 'lons': lons,
+              'flags': np.array(flags, dtype=np.uint32),
+              'level1': np.array([s.ev_level1_evse_num or 0 for s in stations], dtype=np.uint16),
+              'level2': np.array([s.ev_level2_evse_num or 0 for s in stations], dtype=np.uint16),
+              'dc_fast': np.array([s.ev_dc_fast_num or 0 for s in stations], dtype=np.uint16),
+              'indptr': np.array(indptr, dtype=np.int64),
+              'indices': np.array(indices, dtype=np.int32),
+              'miles': np.array(miles, dtype=np.float32)}
+    for field in TEXT_FIELDS:
+        arrays[field] = np.array([getattr(s, field) or '' for s in stations], dtype=str)
+
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as writer:
+        np.savez(writer, **arrays)
+        writer.flush()
+        os.fsync(writer.fileno())
+    os.replace(tmp, path)
+    return n, len(indices)
+
+
+class StationGraph:
+    """ The precomputed station graph, loaded from disk on first use and
+        reloaded whenever the file is replaced. """
+
+    def __init__(self, path, check_interval=60):
+        self.path = path
+        self.check_interval = check_interval
+        self._data = None
+        self._stat = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        now = time.monotonic()
+        if self._data is not None and now - self._checked < self.check_interval:
+            return self._data
+        with self._lock:
+            self._checked = now
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return self._data
+            if self._data is None or (stat.st_ino, stat.st_mtime_ns) != self._stat:
+                with np.load(self.path) as arrays:
+                    self._data = {name: arrays[name] for name in arrays.files}
+                self._stat = (stat.st_ino, stat.st_mtime_ns)
+                logger.info("Loaded station graph with {} stations.".format(len(self._data['ids'])))
+        return self._data
+
+    @property
+    def ready(self):
+        return self._load() is not None
+
+    def station(self, data, i):
+        """ Builds the Station record for a node. """
+        station = Station.__new__(Station)
+        for name in Station.__slots__:
+            setattr(station, name, None)
+        for field in TEXT_FIELDS:
+            setattr(station, field, str(data[field][i]) or None)
+        station.id = int(data['ids'][i])
+        station.latitude = float(data['lats'][i])
+        station.longitude = float(data['lons'][i])
+        station.ev_connector_types = [c for k, c in enumerate(CONNECTORS) if data['flags'][i] & (1 << k)]
+        station.ev_level1_evse_num = int(data['level1'][i]) or None
+        station.ev_level2_evse_num = int(data['level2'][i]) or None
+        station.ev_dc_fast_num = int(data['dc_fast'][i]) or None
+        return station
+
+    def plan(self, origin, destination, vehicle, charge):
+        """ Plans the quickest set of charging stops from origin to
+            destination. Returns (stops, miles, hours), where each stop is a
+            (station, miles driven to get there, hours spent charging). Stops
+            is empty if we can make it without charging, and the whole thing
+            is None if we can't find a way there. """
+        speed = settings['Planner'].get('SPEED', 55)
+        # Every stop costs something on top of the charging itself: getting
+        # off the road, finding the charger and plugging in.
+        stop_hours = settings['Planner'].get('STOP_MINUTES', 10) / 60.0
+        start_range, full_range = vehicle.range_at(charge), vehicle.range_at(1.0)
+        direct = road_miles(haversine(origin[0], origin[1], destination[0], destination[1]))
+        if direct <= start_range:
+            return [], direct, direct / speed
+
+        data = self._load()
+        if data is None:
+            logger.warning("No station graph to plan with.")
+            return None
+        n = len(data['ids'])
+        from_origin = road_miles(haversine_many(float(origin[0]), float(origin[1]),
+                                                data['lats'], data['lons']))
+        to_destination = road_miles(haversine_many(float(destination[0]), float(destination[1]),
+                                                   data['lats'], data['lons']))
+
+        # Stations the car can't plug into, or can't charge at, are left out.
+        # DC fast rates only count where the DC plugs match the car's, which
+        # is what Vehicle.charge_rate does too.
+        fits = np.ones(n, dtype=bool)
+        dc_fits = data['dc_fast'] > 0
+        if vehicle.connectors:
+            wanted = sum(1 << CONNECTORS.index(c) for c in vehicle.connectors if c in CONNECTORS)
+            fits = (data['flags'] & wanted) != 0
+            wanted_dc = sum(1 << CONNECTORS.index(c) for c in vehicle.connectors if c in DC_CONNECTORS)
+            dc_fits &= (data['flags'] & wanted_dc) != 0
+        # Hours spent charging for each mile of the next leg, at each station.
+        rate = np.where(data['level1'] > 0, min(vehicle.max_ac, LEVEL1_KW), 0.0)
+        rate = np.where(data['level2'] > 0, min(vehicle.max_ac, LEVEL2_KW), rate)
+        if vehicle.max_dc:
+            rate = np.where(dc_fits, vehicle.max_dc, rate)
+        fits &= rate > 0
+        with np.errstate(divide='ignore'):
+            hours_per_mile = 1.0 / (rate * vehicle.miles_per_kwh)
+
+        # Nodes 0..n-1 are stations, n is the origin and n + 1 the destination.
+        # The heuristic is the time it'd take to drive straight there.
+        ORIGIN, DESTINATION = n, n + 1
+        best, previous, heap = {ORIGIN: 0.0}, {}, []
+
+        def relax(u, v, cost, miles):
+            if cost < best.get(v, np.inf):
+                best[v] = cost
+                previous[v] = (u, miles)
+                heuristic = 0.0 if v == DESTINATION else to_destination[v] / speed
+                heapq.heappush(heap, (cost + heuristic, cost, v))
+
+        for v in np.nonzero(fits & (from_origin <= start_range))[0]:
+            relax(ORIGIN, int(v), from_origin[v] / speed, float(from_origin[v]))
+
+        indptr, indices, miles = data['indptr'], data['indices'], data['miles']
+        while heap:
+            _, cost, u = heapq.heappop(heap)
+            if u == DESTINATION:
+                break
+            if cost > best[u]:
+                continue
+            if to_destination[u] <= full_range:
+                leg = float(to_destination[u])
+                relax(u, DESTINATION, cost + stop_hours + leg / speed + leg * hours_per_mile[u], leg)
+            for k in range(indptr[u], indptr[u + 1]):
+                v, leg = int(indices[k]), float(miles[k])
+                if leg <= full_range and fits[v]:
+                    relax(u, v, cost + stop_hours + leg / speed + leg * hours_per_mile[u], leg)
+
+        if DESTINATION not in previous:
+            return None
+
+        # Walk back from the destination to get our stops in order.
+        path, node = [], DESTINATION
+        while node != ORIGIN:
+            before, leg = previous[node]
+            path.append((node, leg))
+            node = before
+        path.reverse()
+        stops = [(self.station(data, node), leg, next_leg * float(hours_per_mile[node]))
+                 for (node, leg), (_, next_leg) in zip(path, path[1:])]
+        return stops, sum(leg for _, leg in path), best[DESTINATION]
+
+
+def make_station_graph():
+    """ Builds our station graph from the "Planner" block of our config. """
+    config = settings.get('Planner') or {}
+    return StationGraph(config.get('GRAPH', 'instance/station-graph.npz'),
+                        check_interval=config.get('GRAPH_CHECK', 60))
+
+
+def make_vehicles():
+    """ Builds each of the cars under "Vehicles" in our config, by name in
+        lower case. Anything a car doesn't list comes from "Vehicle". """
+    default = settings.get('Vehicle') or {}
+    return {name.lower(): make_vehicle(dict(default, NAME=name, **(config or {})))
+            for name, config in (settings.get('Vehicles') or {}).items()}
+
+
+def known_vehicle(name):
+    """ The car with this name, or None if it isn't one we know. """
+    name = ' '.join(str(name or '').lower().split())
+    if name == vehicle.name.lower():
+        return vehicles.get(name, vehicle)
+    return vehicles.get(name)
+
+
+def vehicle_for(name):
+    """ The car with this name, or our default car if we don't know it. """
+    return (known_vehicle(name) or vehicle) if name else vehicle
+
+
+# The cars and station graph shared by the whole app.
+vehicle = make_vehicle()
+vehicles = make_vehicles()
+station_graph = make_station_graph()
+
+
+if __name__ == '__main__':
+    from index import fetch_all_stations
+    from snapshot import Snapshot
+
+    command, args = (sys.argv[1:2] or [''])[0], sys.argv[2:]
+    if command != 'build':
+        print(__doc__)
+        sys.exit(1)
+
+    config = settings.get('Planner') or {}
+    snapshot_path = settings['Index'].get('SNAPSHOT')
+    if snapshot_path and os.path.exists(snapshot_path):
+        snapshot = Snapshot(snapshot_path)
+        stations = [snapshot[row] for row in range(len(snapshot))]
+    else:
+        stations = fetch_all_stations()
+
+    path = args[0] if args else station_graph.path
+    nodes, edges = build_graph(stations, path, max_hop=config.get('MAX_HOP', 300),
+                               band=config.get('BAND', 50), per_cell=config.get('PER_CELL', 2),
+                               dc_fast_only=config.get('DC_FAST_ONLY', True))
+    print("Wrote a graph of {} stations and {} hops to {}".format(nodes, edges, path))
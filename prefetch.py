@@ -0,0 +1,124 @@
+""" prefetch.py ===============================================================
+Almost everyone who opens the skill asks for a station right after, from the
+same spot. So when a LaunchRequest comes in, we start on the follow-up's work
+(finding the user's location, and warming the station and amenity caches)
+while they're still listening to the welcome message.
+
+The work is keyed by session id. When the GetStationIntent arrives in the
+same session, it picks up the prefetch, whether that is still running or
+already done, instead of starting from scratch.
+
+A burst of launches shouldn't be able to eat our upstream quota, so only
+MAX_INFLIGHT prefetches can run at once, and any extra launches just don't
+get one. Prefetches nobody claims within TTL seconds, or whose session ends
+first, are dropped. If they haven't started yet, they are cancelled.
+=========================================================================== """
+import threading, time
+from collections import OrderedDict
+from config import logger, settings
+from pipeline import executor
+
+
+class Prefetcher:
+    """ Session-keyed background work, with a cap on how much runs at once. """
+
+    def __init__(self, max_inflight=4, ttl=30, max_sessions=1000):
+        self.max_inflight = max_inflight
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.started = self.skipped = self.used = self.dropped = 0
+        self._entries = OrderedDict()
+        self._inflight = 0
+        self._lock = threading.Lock()
+
+    def start(self, key, fn, *args, **kwargs):
+        """ Runs fn in the background for a session. Returns its future, or
+            None if too many prefetches are already running. """
+        now = time.monotonic()
+        started = False
+        with self._lock:
+            dropped = self._expire(now)
+            if key in self._entries:
+                future = self._entries[key][0]
+            elif self._inflight >= self.max_inflight:
+                self.skipped += 1
+                logger.debug("Too many prefetches running, skipping this one.")
+                future = None
+            else:
+                self._inflight += 1
+                self.started += 1
+                future = executor.submit(fn, *args, **kwargs)
+                self._entries[key] = (future, now)
+                while len(self._entries) > self.max_sessions:
+                    dropped.append(self._entries.popitem(last=False)[1])
+                started = True
+        # This also fires if the future gets cancelled before it runs, and
+        # straight away if it's already finished, so it can't go under the lock.
+        if started:
+            future.add_done_callback(self._done)
+        self._cancel(dropped)
+        return future
+
+    def take(self, key):
+        """ Claims the prefetch for a session, if there is one. """
+        with self._lock:
+            dropped = self._expire(time.monotonic())
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.used += 1
+        self._cancel(dropped)
+        return entry[0] if entry is not None else None
+
+    def drop(self, key):
+        """ Throws away a session's prefetch, say when the session ends. """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._cancel([entry])
+
+    def _expire(self, now):
+        """ Takes out the entries older than ttl, and returns them. Call with
+            the lock held, then pass them to _cancel once it's released. """
+        # Entries are kept in the order they started, so the oldest are first.
+        expired = []
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry[1] < self.ttl:
+                break
+            del self._entries[key]
+            expired.append(entry)
+        return expired
+
+    def _cancel(self, entries):
+        # Never call this with the lock held. Cancelling a future that hasn't
+        # started runs _done straight away, on this thread, and _done needs
+        # the lock too.
+        for future, _ in entries:
+            future.cancel()
+        if entries:
+            with self._lock:
+                self.dropped += len(entries)
+
+    def _done(self, future):
+        with self._lock:
+            self._inflight -= 1
+
+    def stats(self):
+        return {'sessions': len(self._entries),
+                'inflight': self._inflight,
+                'started': self.started,
+                'skipped': self.skipped,
+                'used': self.used,
+                'dropped': self.dropped}
+
+
+def make_prefetcher():
+    """ Builds our prefetcher from the "Prefetch" block of our config. """
+    config = settings.get('Prefetch') or {}
+    return Prefetcher(max_inflight=config.get('MAX_INFLIGHT', 4),
+                      ttl=config.get('TTL', 30),
+                      max_sessions=config.get('MAX_SESSIONS', 1000))
+
+
+# This is the prefetcher shared by the whole app.
+prefetcher = make_prefetcher()
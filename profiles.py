@@ -0,0 +1,199 @@
+""" profiles.py ===============================================================
+Each user's preferences, keyed by their Alexa user id: the charging networks
+they like, the plug their car takes, what they're willing to pay, the kind of
+places they like to wait at, and which car they drive. These get read on every
+station lookup, so reading one has to be about as cheap as a dict lookup.
+
+Profiles are kept in memory, with the most recently used FRONT_SIZE users in
+an LRU. Anything that falls out of it, or that we haven't seen since we
+started, is read back from the backend on the next request. Entries are also
+re-read after FRONT_TTL seconds, so a change saved by another worker on the
+same box shows up here within that time.
+
+Changes are made in memory straight away, so the user's next request already
+sees them. They're written to the backend later, from a background thread,
+every FLUSH_INTERVAL seconds or once BATCH_SIZE users have changes waiting,
+whichever comes first. Until then, a pending change takes precedence over
+whatever the backend has. If the writer hasn't been started (e.g. on Lambda,
+where we might be frozen at any moment), changes are written straight away.
+
+The backend is a small SQLite database by default. Anything with the same
+load() and save() methods as SQLiteProfiles can be passed in instead.
+=========================================================================== """
+import atexit, json, sqlite3, threading, time
+from collections import OrderedDict
+from config import logger, settings
+
+
+# The preferences we know about. Anything else gets ignored.
+FIELDS = ('networks', 'connectors', 'pricing', 'amenities', 'vehicle')
+
+
+class SQLiteProfiles:
+    """ Stores profiles as JSON, one row per user. """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS profiles ("
+                         "user_id TEXT PRIMARY KEY, "
+                         "profile TEXT NOT NULL, "
+                         "updated_at REAL NOT NULL)")
+        self._db.commit()
+
+    def load(self, user_id):
+        """ Returns a user's saved profile, or None. """
+        with self._lock:
+            row = self._db.execute("SELECT profile FROM profiles WHERE user_id = ?",
+                                   (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, profiles):
+        """ Saves {user id: profile} in a single transaction. """
+        now = time.time()
+        with self._lock:
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO profiles VALUES (?, ?, ?)",
+                                     [(user_id, json.dumps(profile), now)
+                                      for user_id, profile in profiles.items()])
+
+
+class ProfileStore:
+    """ User id -> preferences, with an LRU in front and write-behind saves. """
+
+    def __init__(self, backend, front_size=10000, front_ttl=60, flush_interval=2.0,
+                 batch_size=100):
+        self.backend = backend
+        self.front_size = front_size
+        self.front_ttl = front_ttl
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.hits = self.misses = self.flushes = self.failures = 0
+        self._front = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def get(self, user_id):
+        """ Returns a user's preferences, as a dict. Users we don't know about
+            get an empty one. Don't change it, use update() instead. """
+        if not user_id:
+            return {}
+        now = time.monotonic()
+        with self._lock:
+            entry = self._front.get(user_id)
+            if entry is not None and (user_id in self._pending or now - entry[1] < self.front_ttl):
+                self._front.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        try:
+            profile = self.backend.load(user_id) or {}
+        except Exception as e:
+            logger.warning("Couldn't load the profile for {}: {}".format(user_id, e))
+            profile = entry[0] if entry is not None else {}
+
+        with self._lock:
+            # A change may have come in while we were reading, and may even
+            # be on its way to the backend already.
+            entry = self._front.get(user_id)
+            if entry is not None and entry[1] >= now:
+                profile = entry[0]
+            profile = self._pending.get(user_id, profile)
+            self._remember(user_id, profile, now)
+        return profile
+
+    def update(self, user_id, **changes):
+        """ Changes some of a user's preferences. A value of None clears it.
+            Returns the new profile. """
+        changes = {name: value for name, value in changes.items() if name in FIELDS}
+        # This makes sure the profile is in memory. The merge itself happens
+        # under the lock, on whatever is newest by then, so two updates at
+        # once can't undo each other.
+        loaded = self.get(user_id)
+
+        with self._lock:
+            entry = self._front.get(user_id)
+            profile = dict(self._pending.get(user_id, entry[0] if entry is not None else loaded))
+            for name, value in changes.items():
+                if value is None:
+                    profile.pop(name, None)
+                else:
+                    profile[name] = value
+            self._pending[user_id] = profile
+            self._remember(user_id, profile, time.monotonic())
+            waiting = len(self._pending)
+
+        if self._thread is None:
+            self.flush()
+        elif waiting >= self.batch_size:
+            self._wake.set()
+        return profile
+
+    def flush(self):
+        """ Writes all pending changes to the backend. If that fails, they're
+            kept, and tried again on the next flush. """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            try:
+                self.backend.save(batch)
+            except Exception as e:
+                logger.warning("Failed to save {} profiles: {}".format(len(batch), e))
+                self.failures += 1
+                with self._lock:
+                    for user_id, profile in batch.items():
+                        self._pending.setdefault(user_id, profile)
+                return 0
+            self.flushes += 1
+            return len(batch)
+
+    def start(self):
+        """ Starts the background writer thread. Whatever is still pending
+            gets written when the process exits. """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def _remember(self, user_id, profile, now):
+        self._front[user_id] = (profile, now)
+        self._front.move_to_end(user_id)
+        while len(self._front) > self.front_size:
+            self._front.popitem(last=False)
+
+    def stats(self):
+        return {'users': len(self._front),
+                'pending': len(self._pending),
+                'hits': self.hits,
+                'misses': self.misses,
+                'flushes': self.flushes,
+                'failures': self.failures}
+
+
+def make_profile_store():
+    """ Builds our profile store from the "Profiles" block of our config. """
+    config = settings.get('Profiles') or {}
+    return ProfileStore(SQLiteProfiles(config.get('PATH', 'instance/profiles.db')),
+                        front_size=config.get('FRONT_SIZE', 10000),
+                        front_ttl=config.get('FRONT_TTL', 60),
+                        flush_interval=config.get('FLUSH_INTERVAL', 2.0),
+                        batch_size=config.get('BATCH_SIZE', 100))
+
+
+# This is the profile store shared by the whole app.
+profiles = make_profile_store()
@@ -0,0 +1,209 @@
+""" providers.py ==============================================================
+Every upstream API we talk to (NREL, Yelp, HERE) gets its own ProviderClient.
+Each client keeps a pool of keep-alive connections open to its host, so we
+don't pay for a new TCP and TLS handshake on every request. It also applies
+the same timeouts, retries and circuit breaking to every call we make.
+
+A single call never takes longer than BUDGET seconds (or the budget the
+caller passes in), all retries included, or than whatever is left of the
+request's Deadline (see pipeline.py), if it's running under one. Timeouts are cut short and retries skipped to fit. We
+can't cancel a call once it's running, so this is what keeps a slow provider
+from holding on to our worker threads long after the user has been answered.
+
+If a provider starts failing over and over, its circuit breaker "opens" and we
+fail fast with ProviderUnavailable for a while, instead of tying up our worker
+threads waiting on a host that's down. After a cool-down we let a single trial
+request through, and close the breaker again if it works.
+
+Settings live under "Providers" in instance/config.yaml. The "default" block
+applies to everyone, and each provider can override any of it.
+=========================================================================== """
+import json, random, threading, time
+import requests
+from requests.adapters import HTTPAdapter
+from config import logger, settings
+from metrics import metrics
+from pipeline import time_left
+
+
+# Used for anything that isn't set in instance/config.yaml.
+DEFAULTS = {'POOL_SIZE': 10,
+            'CONNECT_TIMEOUT': 2.0,
+            'READ_TIMEOUT': 4.0,
+            'RETRIES': 2,
+            'BACKOFF': 0.2,
+            'BUDGET': 6.0,
+            'BREAKER_THRESHOLD': 5,
+            'BREAKER_RESET': 30}
+
+# Status codes that are worth trying again.
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class ProviderUnavailable(Exception):
+    """ Raised when a provider's circuit breaker is open, or when it keeps
+        failing after we've used up our retries. """
+
+
+class CircuitBreaker:
+    """ Counts consecutive failures and trips open once they pass a threshold. """
+
+    def __init__(self, threshold=5, reset_after=30):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self.trial else 'open'
+
+    def allow(self):
+        """ Returns True if a request is allowed through right now. """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            # Once the cool-down is over, let exactly one trial request through.
+            if not self.trial and time.monotonic() - self.opened_at >= self.reset_after:
+                self.trial = True
+                return True
+            return False
+
+    def release(self):
+        """ Gives back a trial we were allowed but never used, without
+            counting it either way, so the next request can have it. """
+        with self._lock:
+            self.trial = False
+
+    def success(self):
+        with self._lock:
+            self.failures, self.opened_at, self.trial = 0, None, False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened_at, self.trial = time.monotonic(), False
+
+
+class ProviderClient:
+    """ A pooled, keep-alive HTTP client for a single upstream provider. """
+
+    def __init__(self, name, headers=None, **options):
+        self.name = name
+        self.options = dict(DEFAULTS, **options)
+        self.timeout = (self.options['CONNECT_TIMEOUT'], self.options['READ_TIMEOUT'])
+        self.breaker = CircuitBreaker(self.options['BREAKER_THRESHOLD'],
+                                      self.options['BREAKER_RESET'])
+
+        # pool_block makes extra threads wait for a free connection, rather
+        # than opening more and more of them against a struggling host.
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        adapter = HTTPAdapter(pool_connections=1, pool_block=True,
+                              pool_maxsize=self.options['POOL_SIZE'])
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url, params=None, timeout=None, parse=json.loads, budget=None):
+        """ Sends a GET request and returns the decoded JSON response. Pass
+            your own parse function to decode the raw response bytes yourself. """
+        return self.request('GET', url, params=params, timeout=timeout, parse=parse, budget=budget)
+
+    def post(self, url, data=None, params=None, timeout=None, parse=json.loads, budget=None):
+        """ Sends a form-encoded POST request, for queries too big for a URL. """
+        return self.request('POST', url, params=params, data=data, timeout=timeout, parse=parse,
+                            budget=budget)
+
+    def request(self, method, url, params=None, data=None, timeout=None, parse=json.loads,
+                budget=None):
+        """ Sends a request with our timeouts, retries and circuit breaker.
+            budget is the most time (in seconds) to spend on it, retries and
+            all, and defaults to BUDGET. """
+        with metrics.span('provider.' + self.name):
+            return self._request(method, url, params, data, timeout, parse, budget)
+
+    def _request(self, method, url, params, data, timeout, parse, budget):
+        # Our own budget, or the request's, whichever runs out first. Check it
+        # before the breaker, so we don't take a half-open trial we can't use.
+        budget = self.options['BUDGET'] if budget is None else budget
+        left = time_left()
+        if left is not None:
+            budget = min(budget, left)
+        if budget <= 0:
+            raise ProviderUnavailable("No time left to call {}.".format(self.name))
+        if not self.breaker.allow():
+            raise ProviderUnavailable("{} circuit is open.".format(self.name))
+        expires = time.monotonic() + budget
+        timeout = timeout or self.timeout
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+
+        retries = self.options['RETRIES']
+        error, attempts = None, 0
+        for attempt in range(retries + 1):
+            remaining = expires - time.monotonic()
+            if remaining <= 0:
+                break
+            attempts += 1
+            try:
+                r = self.session.request(method, url, params=params, data=data,
+                                         timeout=(min(connect_timeout, remaining),
+                                                  min(read_timeout, remaining)))
+                if r.status_code not in RETRY_STATUS:
+                    r.raise_for_status()
+                    self.breaker.success()
+                    return parse(r.content)
+                error = requests.HTTPError("{} returned {}".format(self.name, r.status_code))
+            except requests.HTTPError:
+                # A 4xx is our fault, not theirs, so don't hold it against them.
+                self.breaker.success()
+                raise
+            except requests.RequestException as e:
+                if isinstance(e, requests.Timeout):
+                    metrics.timeout('provider.' + self.name)
+                error = e
+
+            logger.debug("{} request failed (attempt {}): {}".format(self.name, attempt + 1, error))
+            if attempt < retries:
+                # Exponential backoff with "full jitter", so a crowd of workers
+                # retrying at once doesn't all hit the provider at the same time.
+                # There's no point waiting if there'd be no time left to retry.
+                pause = random.uniform(0, self.options['BACKOFF'] * 2 ** attempt)
+                if time.monotonic() + pause >= expires:
+                    break
+                time.sleep(pause)
+
+        if error is None:
+            # We ran out of time before we could even try, which says nothing
+            # about the provider. If this was a half-open trial, hand it back.
+            self.breaker.release()
+            raise ProviderUnavailable("No time left to call {}.".format(self.name))
+        self.breaker.failure()
+        raise ProviderUnavailable("{} failed after {} attempts: {}".format(
+                                  self.name, attempts, error))
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def circuit_states():
+    """ The circuit breaker state of every client we've created so far. """
+    return {name: client.breaker.state for name, client in _clients.items()}
+
+
+def get_client(name, headers=None):
+    """ Returns the shared client for a provider, creating it on first use. """
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                providers = settings.get('Providers') or {}
+                options = dict(providers.get('default') or {}, **(providers.get(name) or {}))
+                client = _clients[name] = ProviderClient(name, headers, **options)
+    return client
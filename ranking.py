@@ -0,0 +1,116 @@
+""" ranking.py ================================================================
+Rather than asking NREL for a separate, narrowly filtered list of stations for
+every combination of preferences, we fetch one wider list of candidates and
+rank it ourselves. This file scores a whole list of stations at once using
+NumPy arrays, so ranking fifty stations costs about the same as ranking five.
+
+Each station gets a score made up of:
+
+    * distance from the user (closer is better),
+    * whether its pricing matches what the user wants (e.g. "Free"),
+    * whether it's on one of the user's preferred networks,
+    * how many level 2 and DC fast ports it has,
+    * a bonus for DC fast charging if the user asked for it.
+
+Connector type is a hard requirement: a station the car can't plug into gets
+dropped no matter how close it is. So is range, if we're given one: stations
+further than 'max_miles' away are dropped too. The weights can be tuned under "Ranking"
+in instance/config.yaml.
+=========================================================================== """
+import numpy as np
+from config import settings
+
+
+EARTH_RADIUS = 3958.8
+
+DEFAULT_WEIGHTS = {'DISTANCE': 1.0,
+                   'PRICING': 0.5,
+                   'NETWORK': 0.4,
+                   'PORTS': 0.2,
+                   'DC_FAST': 0.6}
+
+
+def haversine_many(lat, lon, lats, lons):
+    """ Distance in miles from one point to an array of points. """
+    lat, lon = np.radians(lat), np.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = (np.sin((lats - lat) / 2) ** 2 +
+         np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def _as_set(value):
+    """ Preferences may be a single value, a comma separated string or a list. """
+    if not value:
+        return set()
+    if isinstance(value, str):
+        value = value.split(',')
+    return {str(v).strip().upper() for v in value if str(v).strip()}
+
+
+def station_columns(stations):
+    """ Pulls the fields we score on out of a list of stations and into
+        column arrays, one entry per station. """
+    n = len(stations)
+    return {'lat': np.fromiter((s.latitude for s in stations), float, n),
+            'lon': np.fromiter((s.longitude for s in stations), float, n),
+            'level2': np.fromiter((s.ev_level2_evse_num or 0 for s in stations), float, n),
+            'dc_fast': np.fromiter((s.ev_dc_fast_num or 0 for s in stations), float, n),
+            'pricing': np.array([(s.ev_pricing or '').lower() for s in stations], dtype=object),
+            'network': np.array([(s.ev_network or '').upper() for s in stations], dtype=object),
+            'connectors': [{c.upper() for c in s.ev_connector_types or []} for s in stations]}
+
+
+def score_stations(stations, origin, preferences=None, weights=None):
+    """ Scores every station in one pass. Returns (scores, distances), where
+        stations that don't fit the car, or are out of range, get a score of
+        -inf. """
+    preferences = preferences or {}
+    weights = dict(DEFAULT_WEIGHTS, **(weights or settings.get('Ranking') or {}))
+    cols = station_columns(stations)
+
+    distance = haversine_many(float(origin[0]), float(origin[1]), cols['lat'], cols['lon'])
+    scores = -weights['DISTANCE'] * distance / max(float(distance.max()), 1.0)
+
+    pricing = (preferences.get('ev_pricing') or '').lower()
+    if pricing:
+        matches = np.fromiter((pricing in p for p in cols['pricing']), bool, len(stations))
+        scores += weights['PRICING'] * matches
+
+    # People say "ChargePoint", NREL says "ChargePoint Network".
+    networks = _as_set(preferences.get('ev_network'))
+    if networks:
+        scores += weights['NETWORK'] * np.fromiter(
+            (any(n in network for n in networks) for network in cols['network']), bool, len(stations))
+
+    ports = cols['level2'] + cols['dc_fast']
+    scores += weights['PORTS'] * np.log1p(ports) / np.log1p(max(float(ports.max()), 1.0))
+
+    if preferences.get('dc_fast'):
+        scores += weights['DC_FAST'] * (cols['dc_fast'] > 0)
+
+    connectors = _as_set(preferences.get('ev_connector_type'))
+    if connectors:
+        fits = np.fromiter((bool(c & connectors) for c in cols['connectors']), bool, len(stations))
+        scores[~fits] = -np.inf
+
+    max_miles = preferences.get('max_miles')
+    if max_miles is not None:
+        scores[distance > max_miles] = -np.inf
+
+    return scores, distance
+
+
+def rank_stations(stations, origin, preferences=None, k=3, weights=None):
+    """ Returns the top k stations for this user, best first, each with its
+        distance from the origin filled in. """
+    stations = list(stations)
+    if not stations:
+        return []
+
+    scores, distance = score_stations(stations, origin, preferences, weights)
+    k = min(k, len(stations))
+    # argpartition finds the top k without sorting the whole list.
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind='stable')]
+    return [stations[i].with_distance(float(distance[i])) for i in top if np.isfinite(scores[i])]
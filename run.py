@@ -10,50 +10,62 @@ return a formatted response to the alexa service using their skill builder.
 ============================================================================ """
 
 # All our imports go here.
-from flask import Flask
+from flask import Flask, jsonify
 from config import logger, settings
-from ask_sdk_core.skill_builder import CustomSkillBuilder
-from ask_sdk_core.api_client import DefaultApiClient
 from flask_ask_sdk.skill_adapter import SkillAdapter
-# from ask_sdk_core.view_resolvers import FileSystemTemplateLoader
-# from ask_sdk_jinja_renderer import JinjaTemplateRenderer
-from skills import (LaunchRequestHandler, GetStationHandler, HelpIntentHandler,
-                    CancelOrStopIntentHandler, FallbackIntentHandler,
-                    SessionEndedRequestHandler, GetAddressExceptionHandler,
-                    CatchAllExceptionHandler)
+from builder import create_skill_builder
+from index import station_index
+from tracing import trace_buffer, install_signal_handler
+from metrics import metrics
+from cache import station_cache, yelp_cache, drive_time_cache
+from providers import circuit_states
+from prefetch import prefetcher
+from profiles import profiles
 
 
-# Initialize our base skill by invoking CustomSkillBuilder.
-sb = CustomSkillBuilder(api_client=DefaultApiClient())
+# This is the unique ID of our skill, found in the alexa developer console.
+SKILL_ID = settings['Alexa']['SKILL_ID']
 
-# Register all handlers, interceptors etc. From skills.py.
-sb.add_request_handler(LaunchRequestHandler())
-sb.add_request_handler(GetStationHandler())
-sb.add_request_handler(HelpIntentHandler())
-sb.add_request_handler(CancelOrStopIntentHandler())
-sb.add_request_handler(FallbackIntentHandler())
-sb.add_request_handler(SessionEndedRequestHandler())
 
-# Don't forget to add our exception handlers as well.
-sb.add_exception_handler(GetAddressExceptionHandler())
-sb.add_exception_handler(CatchAllExceptionHandler())
+def create_app(skill, verify=True):
+    """ Wraps our skill in a Flask app. Turning off verify skips Alexa's
+        request signature and timestamp checks, which is handy for replaying
+        recorded requests, but should never be done in production. """
 
-# Load our Jinja response templates from the templates directory.
-# sb.add_loaders(FileSystemTemplateLoader(dir_path="templates", encoding='utf-8'))
+    # Initialize our flask instance, then pass into the skill builder with our ID.
+    app = Flask(__name__)
+    app.config['ASK_SDK_VERIFY_SIGNATURE'] = verify
+    app.config['ASK_SDK_VERIFY_TIMESTAMP'] = verify
+    skill_response = SkillAdapter(skill=skill, skill_id=SKILL_ID, app=app)
+    skill_response.register(app=app, route="/")
 
-# Add default jinja renderer on skill builder.
-# sb.add_renderer(JinjaTemplateRenderer())
+    @app.route("/metrics")
+    def get_metrics():
+        """ Latency histograms, cache counters and circuit breaker states. """
+        return jsonify({'latency': metrics.report(),
+                        'cache': {c.name: c.stats() for c in (station_cache, yelp_cache, drive_time_cache)},
+                        'circuits': circuit_states(),
+                        'prefetch': prefetcher.stats(),
+                        'profiles': profiles.stats(),
+                        'index': {'stations': len(station_index), 'updated_at': station_index.updated_at}})
 
-# This will be needed when our code is uploaded to Amazon's lambda host service.
-# lambda_handler = sb.lambda_handler()
+    return app
 
-# This is the unique ID of our skill, found in the alexa developer console.
-SKILL_ID = settings['Alexa']['SKILL_ID']
 
-# Initialize our flask instance, then pass into the skill builder with our ID.
-app = Flask(__name__)
-skill_response = SkillAdapter(skill=sb.create(), skill_id=SKILL_ID, app=app)
-skill_response.register(app=app, route="/")
+sb = create_skill_builder()
+app = create_app(sb.create())
+
+# When running on Amazon's lambda host service, use lambda_function.py instead.
+
+# Start loading our local copy of the station database in the background.
+station_index.start()
+
+# Start writing traces to disk, and dump the latest ones on SIGUSR1.
+trace_buffer.start()
+install_signal_handler(trace_buffer)
+
+# Save profile changes to disk in batches, in the background.
+profiles.start()
 
 # Config settings for our flask development server.
 if __name__ == '__main__':
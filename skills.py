@@ -7,14 +7,24 @@ request and construct a response to send back to the alexa service.
 ============================================================================ """
 
 # We need to import some stuff
-import requests, json, random
-from config import logger, settings
+import requests, json, random, time
+from config import logger, settings, ON_LAMBDA
 from ask_sdk_core.dispatch_components import AbstractRequestHandler
 from ask_sdk_core.dispatch_components import AbstractExceptionHandler
-from ask_sdk_core.utils import is_request_type, is_intent_name
+from ask_sdk_core.dispatch_components import AbstractRequestInterceptor
+from ask_sdk_core.dispatch_components import AbstractResponseInterceptor
+from ask_sdk_core.utils import is_request_type, is_intent_name, get_request_type, get_intent_name
 from ask_sdk_model.ui import AskForPermissionsConsentCard
 from ask_sdk_model.services import ServiceException
-from utils import ( parse_user_loc, parse_device_loc, get_station_list, get_yelp_results )
+from pipeline import Deadline, DeadlineExceeded, executor
+from prefetch import prefetcher
+from tracing import trace_buffer
+from metrics import metrics
+
+# The station lookup pulls in numpy, SQLite and our provider clients, which
+# take a while to import. A cold start that only has to say hello shouldn't
+# wait on them, so the handlers that need them import them the first time
+# they're called (see lambda_function.py).
 
 
 # Rough implementation of debug mode. Need to refine.
@@ -38,7 +48,31 @@ MISSING_PERMISSIONS = ("Please enable Location permissions in "
 
 MISSING_LOCATION = "It looks like I can't find your current location."
 
+SEARCHING = "Looking for chargers near you."
+
+NO_STATIONS = "I couldn't find any charging stations near you."
+
+OUT_OF_RANGE = ("I couldn't find a charging station you can reach "
+                "on the charge you have left.")
+
+NO_PLUG = "I couldn't find a charging station near you with a plug that fits your car."
+
+NO_DESTINATION = "Where would you like to go?"
+
+NO_ROUTE = "I couldn't find a way to get to {} with the chargers I know about."
+
+NO_STOPS = "You have enough charge to make it to {} without stopping. "
+
+NO_PREFERENCE = "What would you like me to remember?"
+
+SAVED_PREFERENCE = "Okay, I'll remember that you {}."
+
+UNKNOWN_VEHICLE = "Sorry, I don't know the {} yet. I know the {}."
+
+TIMEOUT = "Sorry, that took longer than expected. Please try again."
+
 ERROR = "Uh Oh. Looks like something went wrong."
+PROBLEM = "Sorry, there was some problem. Please try again!!"
 LOCATION_FAILURE = ("There was an error with the Device Address API. "
                     "Please try again.")
 GOODBYE = "Bye! Thanks for using the Sample Device Address API Skill!"
@@ -47,17 +81,48 @@ HELP = ("You can use this skill by asking something like: "
         "whats my address?")
 
 
-# Right now this is a hard-coded filter, but we want to dynamically
-# build it from the user's preferences in the future.
-station_filter = {'ev_pricing': 'Free',
+# We ask NREL (or our index) for a wide set of candidates, then rank them
+# locally against the user's preferences (see ranking.py). That way the same
+# lookup, and the same cache entry, works for everyone nearby.
+station_filter = {'limit': '50'}
+
+# These are the defaults. Anything in the user's profile (see profiles.py)
+# takes precedence.
+preferences = {'ev_pricing': 'Free'}
 
-               'limit': '10'}
+# What people call their plugs, and what NREL calls them.
+CONNECTOR_NAMES = {'ccs': 'J1772COMBO', 'combo': 'J1772COMBO', 'j1772': 'J1772',
+                   'level 2': 'J1772', 'chademo': 'CHADEMO', 'tesla': 'TESLA',
+                   'supercharger': 'TESLA'}
 
 # These are the device permissions we need in order for our skill to work.
 # More information can be found at:
 # https://developer.amazon.com/docs/custom-skills/device-address-api.html#sample-response-with-permission-card
 permissions = ["read::alexa:device:all:address"]
 
+# How many of the top stations we look up amenities for, in parallel.
+CANDIDATES = settings['Pipeline'].get('CANDIDATES', 3)
+
+# Whether to tell the user we're working on it while the lookups run.
+PROGRESSIVE = settings['Pipeline'].get('PROGRESSIVE', True)
+
+# Whether to start on the station lookup as soon as the skill is opened, and
+# the search term to warm the Yelp cache with while we're at it. Lambda freezes
+# us as soon as we've answered, and the next request in the session may not
+# even land on the same instance, so there's no point there.
+PREFETCH = (settings.get('Prefetch') or {}).get('ENABLED', True) and not ON_LAMBDA
+PREFETCH_KEYWORD = (settings.get('Prefetch') or {}).get('KEYWORD')
+
+# How far (in miles) the user can have moved since the prefetch for its
+# stations to still be worth using. A car's GPS fix changes on every request.
+PREFETCH_MAX_MOVE = (settings.get('Prefetch') or {}).get('MAX_MOVE', 0.5)
+
+# How full we tell people their battery will be after charging.
+CHARGE_TARGET = (settings.get('Vehicle') or {}).get('TARGET', 0.8)
+
+# Whether to re-order those candidates by real drive time.
+USE_DRIVE_TIME = (settings.get('Ranking') or {}).get('DRIVE_TIME', False)
+
 
 class LaunchRequestHandler(AbstractRequestHandler):
     """ Initial handler for skill launch. """
@@ -65,6 +130,13 @@ class LaunchRequestHandler(AbstractRequestHandler):
         return is_request_type("LaunchRequest")(handler_input)
 
     def handle(self, handler_input):
+        # The user is most likely about to ask for a station, so get started
+        # on it while they listen to the welcome (see prefetch.py).
+        req_envelope = handler_input.request_envelope
+        if PREFETCH and req_envelope.session and has_permissions(req_envelope):
+            prefetcher.start(req_envelope.session.session_id, prefetch_stations,
+                             req_envelope, handler_input.service_client_factory)
+
         WELCOME = WELCOME_MSG if not debugMode else WELCOME_DEBUG
         handler_input.response_builder.speak(WELCOME).ask(ASK)
         return handler_input.response_builder.response
@@ -84,109 +156,309 @@ class GetStationHandler(AbstractRequestHandler):
         # It makes our lives easier to set these variables at the beginning.
         # To better understand these object, please check out this link:
         # https://developer.amazon.com/docs/custom-skills/request-and-response-json-reference.html
+        from amenities import amenity_index
+        from planner import vehicle_for, road_miles
+        from profiles import profiles
+        from ranking import rank_stations
+        from utils import (parse_user_loc, parse_device_loc, get_station_list, get_yelp_results,
+                           get_drive_times, send_progressive_response)
 
         req_envelope = handler_input.request_envelope
         response_builder = handler_input.response_builder
         service_client_fact = handler_input.service_client_factory
 
-        slots = eval(str(handler_input.request_envelope.request.intent.slots))
-        with open('instance/request.json', 'w') as writer:
-            writer.write(str(slots))
-        slots = [v['value'] for k,v in slots.items() if v['value'] != None]
-        slots = slots[0]
+        # Everything we know about this user and their car.
+        profile = profiles.get(user_id_of(req_envelope))
+        vehicle = vehicle_for(profile.get('vehicle'))
+
+        # Grab the first slot the user actually filled in (e.g. "coffee"). If
+        # they didn't say, go with the kind of place they usually like. The
+        # battery slot is how much charge they have, not a kind of place.
+        intent = req_envelope.request.intent
+        slots = [slot.value for name, slot in (intent.slots or {}).items()
+                 if slot.value is not None and name != 'battery']
+        slots = slots[0] if slots else favourite_amenity(profile)
         logger.debug(slots)
 
 
-        # Feel free to check out the request.json file generated here so you
-        # can get a feel for how the alexa data packet is structured.
+        # Feel free to check out the trace file (see tracing.py) to get a feel
+        # for how the alexa data packet is structured.
 
 
         # If the user permissions and consent token are not present, then we
         # need to prompt the user to give us permission in order to access data
         # on their device. debugMode will bypass this check.
-        if not (req_envelope.context.system.user.permissions and
-                req_envelope.context.system.user.permissions.consent_token):
+        if not has_permissions(req_envelope):
             response_builder.speak(MISSING_PERMISSIONS)
             response_builder.set_card(
                 AskForPermissionsConsentCard(permissions=permissions))
             return response_builder.response
 
-        # Check for the user's geolocation data first, then device data, then prompt.
-        logger.debug("Fetching user's geo-location...")
-        location = parse_user_loc(req_envelope) if not debugMode else loc_debug
-        if not location:
-            logger.debug("Failed to grab geolocation! Checking device address...")
-            location = parse_device_loc(req_envelope, service_client_fact)
-            if not location:
-                logger.debug("Failed to grab device location! Prompting user...")
-                response_builder.reprompt(MISSING_LOCATION).getResponse()
+        # Pick up anything the LaunchRequest already started for us.
+        prefetched = prefetcher.take(req_envelope.session.session_id) if req_envelope.session else None
+
+        # Everything below has to fit inside Alexa's response window, so it
+        # all runs under one deadline. Anything unfinished gets cancelled.
+        with Deadline() as deadline:
+
+            # Check for the user's geolocation data first, then device data, then prompt.
+            with metrics.span('stage.location'):
+                logger.debug("Fetching user's geo-location...")
+                location = parse_user_loc(req_envelope) if not debugMode else loc_debug
+                location, station_list = use_prefetch(deadline, prefetched, location)
+                if not location:
+                    logger.debug("Failed to grab geolocation! Checking device address...")
+                    location = deadline.result(deadline.submit(
+                        parse_device_loc, req_envelope, service_client_fact))
+                    if not location:
+                        logger.debug("Failed to grab device location! Prompting user...")
+                        response_builder.speak(MISSING_LOCATION).ask(MISSING_LOCATION)
+                        return response_builder.response
+
+            # Now that we know where they are, let the user know we're on it.
+            # This goes out in the background, so it doesn't hold up the lookups.
+            if PROGRESSIVE:
+                deadline.background(send_progressive_response, req_envelope,
+                                service_client_fact, SEARCHING)
+
+            # Fetch a list of charging station based on user's preferences.
+            with metrics.span('stage.stations'):
+                if station_list is None:
+                    logger.debug("Fetching station list...")
+                    station_list = deadline.result(deadline.submit(
+                        get_station_list, location, station_filter))
+                    logger.debug("Station list received.")
+            trace_buffer.capture(req_envelope.request.request_id, 'stations', station_list)
+
+            # Only stations the car can plug into, and reach, make the cut.
+            with metrics.span('stage.ranking'):
+                charge = battery_level(intent, vehicle)
+                prefs = station_preferences(profile, vehicle, charge)
+                candidates = rank_stations(station_list, location, prefs, k=CANDIDATES)
+                if not candidates:
+                    # Both the plug and the range are hard limits. Work out
+                    # which one left us with nothing, so we can say so.
+                    if not len(station_list):
+                        reason = NO_STATIONS
+                    elif rank_stations(station_list, location, dict(prefs, max_miles=None), k=1):
+                        reason = OUT_OF_RANGE
+                    else:
+                        reason = NO_PLUG
+                    response_builder.speak(reason).ask(ASK)
+                    return response_builder.response
+
+            # Optionally re-order our top picks by how long they take to drive
+            # to. This is one batched HERE request, no matter how many we have.
+            if USE_DRIVE_TIME:
+                with metrics.span('stage.drive_time'):
+                    try:
+                        routed = deadline.result(deadline.submit(get_drive_times, location, candidates))
+                        # Anything HERE couldn't route keeps its place, after the rest.
+                        routed = [station for station, _ in routed]
+                        ids = {station.id for station in routed}
+                        candidates = routed + [station for station in candidates if station.id not in ids]
+                    except Exception as e:
+                        logger.debug("Couldn't get drive times: {}".format(e))
+
+            # Take the best ranked station that has something nearby to talk
+            # about. Our amenity index (see amenities.py) can usually tell us
+            # straight away, without asking Yelp.
+            with metrics.span('stage.amenities'):
+                local = amenity_index.best(candidates, slots)
+                if local is not None:
+                    logger.debug("Using amenity index.")
+                    select_station, yelp_results = local
+                else:
+                    # We don't know yet which station we'll pick, so look up
+                    # what's nearby for the top few all at once.
+                    logger.debug("Fetching yelp results...")
+                    lookups = [deadline.submit(get_yelp_results, station.location, slots)
+                               for station in candidates]
+
+                    select_station, yelp_results = candidates[0], None
+                    for station, lookup in zip(candidates, lookups):
+                        try:
+                            results = deadline.result(lookup)
+                        except DeadlineExceeded:
+                            logger.debug("Ran out of time waiting on yelp results.")
+                            break
+                        except Exception as e:
+                            logger.debug("Yelp lookup failed: {}".format(e))
+                            continue
+                        if results.get('businesses'):
+                            select_station, yelp_results = station, results
+                            break
+                    logger.debug("Yelp results received!")
+
+        # Build up what we're going to say.
+        with metrics.span('stage.response'):
+            # Station Values
+            station_distance = select_station.distance
+            st_distance = "{} miles".format(round(station_distance)) if station_distance > 1 else "less than a mile"
+            network = select_station.network
+            port_type = ""
+            port_val = random.randint(1,4)
+            port_max = random.randint(4,9)
+            logger.debug("Station values loaded!")
+
+            # How long it'll take to top back up, after driving there.
+            arrival = charge - road_miles(station_distance) / vehicle.range
+            charge_hours = vehicle.charge_hours(select_station, arrival, CHARGE_TARGET)
+            if charge_hours:
+                CHARGE = "It will take about {} of charging to get back to {} percent. ".format(
+                         describe_hours(charge_hours), round(CHARGE_TARGET * 100))
+            else:
+                CHARGE = ""
+            logger.debug("Car values loaded!")
+
+            # Yelp Values
+            if yelp_results:
+                businesses = yelp_results['businesses']
+                top_pick = businesses[random.randint(0, min(2, len(businesses) - 1))]
+                name = top_pick['name']
+                rating = top_pick['rating']
+                yelp_distance = round(top_pick['distance']/84)
+                PLACE = "I found a place called {}. It is a {} minute walk away. ".format(name, yelp_distance)
+            else:
+                PLACE = ""
+            logger.debug("Yelp values loaded!")
+
+            # Variables in dialogue syntax.
+            # pay = "Free" if "Free" in select_station.ev_pricing else "Paid"
+            # hours = "open 24 hours" if "24" in select_station.access_days_time else ""
+
+            logger.debug("Syntax values loaded!")
+
+            RESULT = ( "The nearest {} station is {} away. ".format(network, st_distance) +
+                       "{} of the {} ports are currently open. ".format(port_val, port_max) +
+                       CHARGE +
+                       PLACE +
+                       "Are you interested?")
+
+            logger.debug("Dialogue processed!")
+
+            response_builder.speak(RESULT).ask("Anything else?")
+        return response_builder.response
 
-        # Fetch a list of charging station based on user's preferences.
-        logger.debug("Fetching station list...")
-        station_list = get_station_list(location, station_filter)
-        logger.debug("Station list received. Dumping to JSON.")
-        if debugMode and station_list:
-            with open('instance/stations.json', 'w') as writer:
-                writer.write(str(station_list))
-
-        rand_index = random.randint(0,2)
-        select_station = station_list['fuel_stations'][rand_index]
-        station_address = "{}, {}, {} {}".format(select_station['street_address'],
-                                                 select_station['city'],
-                                                 select_station['state'],
-                                                 select_station['zip'])
-
-        # Pick the top station. We'll have the user do this later.
-        logger.debug("Fetching yelp results...")
-        yelp_results = get_yelp_results(station_address, slots)
-        logger.debug("Yelp results received!")
-
-        # Station Values
-        station_distance = select_station['distance']
-        st_distance = (round(station_distance) + "miles") if station_distance > 1 else "less than a mile"
-        network = select_station["ev_network"] if not "Non" in select_station["ev_network"] else ""
-        port_type = ""
-        port_val = random.randint(1,4)
-        port_max = random.randint(4,9)
-        logger.debug("Station values loaded!")
-
-        # Nissan Leaf
-        total_range = 200
-        total_battery = 60
-        curr_battery = 0.5
-        # full_charge_time = 25, 11, 0.75
-        # charge_time = full_charge_time[port_type] * curr_battery
-        logger.debug("Car values loaded!")
-
-        # Yelp Values
-        rand_index_yelp = random.randint(0,2)
-        top_pick = yelp_results['businesses'][rand_index_yelp]
-        name = top_pick['name']
-        rating = top_pick['rating']
-        yelp_distance = round(top_pick['distance']/84)
-        logger.debug("Yelp values loaded!")
-
-        # Variables in dialogue syntax.
-        # pay = "Free" if "Free" in select_station['ev_pricing'] else "Paid"
-        # hours = "open 24 hours" if "24" in select_station['access_days_time'] else ""
-
-        charge_hours = "{} hours".format(1 + random.randint(1,2))
-        logger.debug("Syntax values loaded!")
-
-        RESULT = ( "The nearest {} station is {} away. ".format(network, st_distance) +
-                   "{} of the {} ports are currently open. ".format(port_val, port_max) +
-                   "It will take about {} of charging to make it home. ".format(charge_hours) +
-                   "I found a place called {}. It is a {} minute walk away. ".format(name, yelp_distance) +
-                   "Are you interested?")
-
-        logger.debug("Dialogue processed!")
-
-        response_builder.speak(RESULT).ask("Anything else?")
-
-        if debugMode and response_builder.response:
-            with open('instance/response.json', 'w') as writer:
-                writer.write(str(response_builder.response))
 
+class PlanTripHandler(AbstractRequestHandler):
+    """ Handler for planning the charging stops on the way to somewhere. """
+    def can_handle(self, handler_input):
+        return is_intent_name("PlanTripIntent")(handler_input)
+
+    def handle(self, handler_input):
+        from planner import vehicle_for, station_graph
+        from profiles import profiles
+        from utils import parse_user_loc, parse_device_loc, convert_to_geo
+
+        req_envelope = handler_input.request_envelope
+        response_builder = handler_input.response_builder
+        service_client_fact = handler_input.service_client_factory
+        vehicle = vehicle_for(profiles.get(user_id_of(req_envelope)).get('vehicle'))
+
+        slot = (req_envelope.request.intent.slots or {}).get('destination')
+        destination_name = slot.value if slot else None
+        if not destination_name:
+            response_builder.speak(NO_DESTINATION).ask(NO_DESTINATION)
+            return response_builder.response
+
+        if not has_permissions(req_envelope):
+            response_builder.speak(MISSING_PERMISSIONS)
+            response_builder.set_card(
+                AskForPermissionsConsentCard(permissions=permissions))
+            return response_builder.response
+
+        with Deadline() as deadline:
+            # Find out where we are and where we're going at the same time.
+            with metrics.span('stage.location'):
+                destination = deadline.submit(convert_to_geo, destination_name)
+                location = parse_user_loc(req_envelope) if not debugMode else loc_debug
+                if not location:
+                    location = deadline.result(deadline.submit(
+                        parse_device_loc, req_envelope, service_client_fact))
+                destination = deadline.result(destination)
+                if not location:
+                    response_builder.speak(MISSING_LOCATION).ask(MISSING_LOCATION)
+                    return response_builder.response
+                if not destination:
+                    response_builder.speak(NO_ROUTE.format(destination_name)).ask(ASK)
+                    return response_builder.response
+
+            # This is a search over our precomputed station graph, no API calls.
+            with metrics.span('stage.planning'):
+                plan = station_graph.plan(location, destination, vehicle,
+                                          battery_level(req_envelope.request.intent, vehicle))
+
+        with metrics.span('stage.response'):
+            if plan is None:
+                response_builder.speak(NO_ROUTE.format(destination_name)).ask(ASK)
+                return response_builder.response
+
+            stops, miles, hours = plan
+            if not stops:
+                RESULT = NO_STOPS.format(destination_name)
+            else:
+                RESULT = "To get to {}, you'll need to stop and charge {}. ".format(
+                         destination_name, "once" if len(stops) == 1 else "{} times".format(len(stops)))
+                for k, (station, leg, charge_hours) in enumerate(stops[:3]):
+                    RESULT += "{} at {} in {}, {} miles {}, for about {}. ".format(
+                              "First," if k == 0 else "Then", station.station_name, station.city,
+                              round(leg), "away" if k == 0 else "later", describe_hours(charge_hours))
+            RESULT += "The whole trip will take about {}.".format(describe_hours(hours))
+            response_builder.speak(RESULT).ask("Anything else?")
+        return response_builder.response
+
+
+class SetPreferenceHandler(AbstractRequestHandler):
+    """ Handler for saving something about the user to their profile, like
+    the car they drive or the network they'd rather charge with. """
+    def can_handle(self, handler_input):
+        return is_intent_name("SetPreferenceIntent")(handler_input)
+
+    def handle(self, handler_input):
+        from planner import known_vehicle, vehicle, vehicles
+        from profiles import profiles
+
+        req_envelope = handler_input.request_envelope
+        response_builder = handler_input.response_builder
+        slots = {name: slot.value for name, slot in (req_envelope.request.intent.slots or {}).items()
+                 if slot.value}
+
+        changes, said, unknown = {}, [], None
+        if 'vehicle' in slots:
+            # Only cars we have the numbers for. Anything else would quietly
+            # get planned as our default car.
+            car = known_vehicle(slots['vehicle'])
+            if car is None:
+                names = sorted({vehicle.name} | {car.name for car in vehicles.values()})
+                names = ", the ".join(names[:-1]) + " or the " + names[-1] if len(names) > 1 else names[0]
+                unknown = UNKNOWN_VEHICLE.format(slots['vehicle'], names)
+            else:
+                changes['vehicle'] = car.name
+                said.append("drive a {}".format(car.name))
+        if 'network' in slots:
+            changes['networks'] = [slots['network']]
+            said.append("like to charge with {}".format(slots['network']))
+        if 'connector' in slots:
+            name = slots['connector'].lower()
+            changes['connectors'] = [CONNECTOR_NAMES.get(name, name.upper().replace(' ', ''))]
+            said.append("need a {} plug".format(slots['connector']))
+        if 'pricing' in slots:
+            changes['pricing'] = slots['pricing']
+            said.append("prefer {} charging".format(slots['pricing']))
+        if 'amenity' in slots:
+            changes['amenities'] = [slots['amenity']]
+            said.append("like to wait somewhere with {}".format(slots['amenity']))
+
+        if not changes:
+            speech = unknown or NO_PREFERENCE
+            response_builder.speak(speech).ask(NO_PREFERENCE)
+            return response_builder.response
+
+        # This only updates memory. It's saved to disk shortly after.
+        profiles.update(user_id_of(req_envelope), **changes)
+        speech = SAVED_PREFERENCE.format(" and ".join(said))
+        response_builder.speak(speech + " " + unknown if unknown else speech).ask(ASK)
         return response_builder.response
 
 
@@ -196,6 +468,9 @@ class SessionEndedRequestHandler(AbstractRequestHandler):
         return is_request_type("SessionEndedRequest")(handler_input)
 
     def handle(self, handler_input):
+        # Nobody is going to use whatever we prefetched for this session now.
+        if handler_input.request_envelope.session:
+            prefetcher.drop(handler_input.request_envelope.session.session_id)
         return handler_input.response_builder.response
 
 
@@ -232,6 +507,162 @@ class FallbackIntentHandler(AbstractRequestHandler):
         return handler_input.response_builder.response
 
 
+def has_permissions(req_envelope):
+    """ True if the user has given us consent to look up their device. """
+    permissions = req_envelope.context.system.user.permissions
+    return bool(permissions and permissions.consent_token)
+
+
+def user_id_of(req_envelope):
+    """ The Alexa user id, which is what profiles are keyed by. """
+    return req_envelope.context.system.user.user_id
+
+
+def favourite_amenity(profile):
+    """ The kind of place the user likes to wait at, if they've told us. """
+    amenities = profile.get('amenities')
+    return amenities[0] if amenities else None
+
+
+def battery_level(intent, vehicle):
+    """ How full the battery is, from 0 to 1, if the user told us (e.g.
+        "I'm at 40 percent"). Otherwise we guess, from the config. """
+    slot = (intent.slots or {}).get('battery')
+    try:
+        percent = float(slot.value)
+    except (AttributeError, TypeError, ValueError):
+        return vehicle.charge
+    return min(max(percent, 0.0), 100.0) / 100.0
+
+
+def station_preferences(profile, vehicle, charge):
+    """ The user's preferences, plus what their car needs: the right plug,
+        and a station it can reach on the charge it has left. """
+    from planner import reachable_miles
+    prefs = dict(preferences, max_miles=reachable_miles(vehicle, charge))
+    if profile.get('pricing'):
+        prefs['ev_pricing'] = profile['pricing']
+    if profile.get('networks'):
+        prefs['ev_network'] = profile['networks']
+    connectors = profile.get('connectors') or vehicle.connectors
+    if connectors:
+        prefs['ev_connector_type'] = connectors
+    return prefs
+
+
+def describe_hours(hours):
+    """ Says a length of time the way a person would. """
+    minutes = int(round(hours * 60 / 5.0)) * 5
+    if minutes < 60:
+        return "{} minutes".format(max(minutes, 5))
+    if minutes < 90:
+        return "an hour" if minutes < 75 else "an hour and a half"
+    return "{} hours".format(round(minutes / 60.0))
+
+
+def prefetch_stations(req_envelope, service_client_fact):
+    """ The first half of GetStationHandler, run ahead of time from the
+        LaunchRequest. Returns (location, station_list), and starts warming
+        the Yelp cache for our top candidates if the amenity index can't
+        answer for them. """
+    from amenities import amenity_index
+    from planner import vehicle_for
+    from profiles import profiles
+    from ranking import rank_stations
+    from utils import parse_user_loc, parse_device_loc, get_station_list, get_yelp_results
+    with metrics.span('stage.prefetch'):
+        location = parse_user_loc(req_envelope) if not debugMode else loc_debug
+        if not location:
+            location = parse_device_loc(req_envelope, service_client_fact)
+        if not location:
+            return None, None
+        station_list = get_station_list(location, station_filter)
+        profile = profiles.get(user_id_of(req_envelope))
+        vehicle = vehicle_for(profile.get('vehicle'))
+        keyword = PREFETCH_KEYWORD or favourite_amenity(profile)
+        # A LaunchRequest has no slots, so we don't know the battery level
+        # yet. This only picks what to warm, GetStation ranks again anyway.
+        candidates = rank_stations(station_list, location,
+                                   station_preferences(profile, vehicle, vehicle.charge),
+                                   k=CANDIDATES)
+        if amenity_index.best(candidates, keyword) is None:
+            for station in candidates:
+                executor.submit(get_yelp_results, station.location, keyword)
+        return location, station_list
+
+
+def use_prefetch(deadline, prefetched, location):
+    """ Returns (location, station_list), using what was prefetched if we
+        can. If we already have a location of our own, we only take the
+        prefetch if it was for somewhere within PREFETCH_MAX_MOVE miles, and
+        measure the distances again from where the user is now. """
+    from index import haversine
+    from utils import measure_from
+    if prefetched is None:
+        return location, None
+    # Even if it's still running, it started well before we did, so it'll
+    # likely be done before a fresh lookup would be.
+    try:
+        prefetched_location, station_list = deadline.result(prefetched)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        logger.debug("Prefetch failed: {!r}".format(e))
+        return location, None
+    if not prefetched_location or station_list is None:
+        return location, None
+    if not location:
+        logger.debug("Using prefetched location and station list.")
+        return prefetched_location, station_list
+    moved = haversine(location[0], location[1], prefetched_location[0], prefetched_location[1])
+    if moved > PREFETCH_MAX_MOVE:
+        logger.debug("Moved {:.1f} miles since the prefetch, not using it.".format(moved))
+        return location, None
+    logger.debug("Using prefetched station list.")
+    return location, measure_from(location, station_list)
+
+
+def request_name(handler_input):
+    """ The intent name for intent requests, otherwise the request type. """
+    request_type = get_request_type(handler_input)
+    return get_intent_name(handler_input) if request_type == "IntentRequest" else request_type
+
+
+def finish_request(handler_input, exception=None):
+    """ Records how long the whole request took, under its intent name. """
+    started = handler_input.attributes_manager.request_attributes.get('started')
+    if started is not None:
+        metrics.record('intent.' + request_name(handler_input),
+                       time.perf_counter() - started, exception)
+
+
+class MetricsRequestInterceptor(AbstractRequestInterceptor):
+    """ Notes when we started working on a request. """
+    def process(self, handler_input):
+        handler_input.attributes_manager.request_attributes['started'] = time.perf_counter()
+
+
+class MetricsResponseInterceptor(AbstractResponseInterceptor):
+    """ Records the request's latency once we have a response. Requests that
+        fail are recorded by the exception handlers instead. """
+    def process(self, handler_input, response):
+        finish_request(handler_input)
+
+
+class TraceRequestInterceptor(AbstractRequestInterceptor):
+    """ Captures incoming request envelopes for the trace buffer. """
+    def process(self, handler_input):
+        req_envelope = handler_input.request_envelope
+        trace_buffer.capture(req_envelope.request.request_id, 'request', req_envelope)
+
+
+class TraceResponseInterceptor(AbstractResponseInterceptor):
+    """ Captures our outgoing responses for the trace buffer. """
+    def process(self, handler_input, response):
+        trace_buffer.capture(handler_input.request_envelope.request.request_id,
+                             'response', response)
+
+
 class GetAddressExceptionHandler(AbstractExceptionHandler):
     """ Custom Exception Handler for handling device address API
         call exceptions. """
@@ -239,9 +670,9 @@ class GetAddressExceptionHandler(AbstractExceptionHandler):
         return isinstance(exception, ServiceException)
 
     def handle(self, handler_input, exception):
-        if debugMode and exception:
-            with open('exception.json', 'w') as writer:
-                writer.write(str(exception))
+        finish_request(handler_input, exception)
+        trace_buffer.capture(handler_input.request_envelope.request.request_id,
+                             'exception', exception)
         if exception.status_code == 403:
             handler_input.response_builder.speak(
                 NOTIFY_MISSING_PERMISSIONS).set_card(
@@ -252,6 +683,18 @@ class GetAddressExceptionHandler(AbstractExceptionHandler):
         return handler_input.response_builder.response
 
 
+class DeadlineExceptionHandler(AbstractExceptionHandler):
+    """ Handler for requests that ran out of time waiting on a provider. """
+    def can_handle(self, handler_input, exception):
+        return isinstance(exception, DeadlineExceeded)
+
+    def handle(self, handler_input, exception):
+        finish_request(handler_input, exception)
+        logger.warning("Request ran out of time: {}".format(exception))
+        handler_input.response_builder.speak(TIMEOUT).ask(TIMEOUT)
+        return handler_input.response_builder.response
+
+
 class CatchAllExceptionHandler(AbstractExceptionHandler):
     """ Default catch-all exception handler. Log exception and
         respond with custom message. """
@@ -259,9 +702,9 @@ class CatchAllExceptionHandler(AbstractExceptionHandler):
         return True
 
     def handle(self, handler_input, exception):
+        finish_request(handler_input, exception)
         print("Encountered following exception: {}".format(exception))
 
-        speech = "Sorry, there was some problem. Please try again!!"
-        handler_input.response_builder.speak(speech).ask(speech)
+        handler_input.response_builder.speak(PROBLEM).ask(PROBLEM)
 
         return handler_input.response_builder.response
@@ -0,0 +1,236 @@
+""" snapshot.py ===============================================================
+A compact, read-only, on-disk copy of the station database. It's built once
+(offline, or from a cron job) and then memory-mapped by every worker process,
+so they all share the same pages from the OS page cache. Opening a snapshot
+doesn't parse anything, and it doesn't copy the data onto each worker's heap.
+
+The file is laid out as a header followed by fixed-width columns, one entry
+per station, plus a table of strings:
+
+    header      magic, version, generation, counts, cell size, offsets
+    latitude    float64     longitude   float64
+    id          uint32      flags       uint32 (connector bits, free pricing)
+    level1      uint16      level2      uint16      dc_fast     uint16
+    strings     uint32 x 8 per station, indexes into the string table
+    cells       int32 i, int32 j, uint32 first row, uint32 row count
+    string table: uint32 offsets, followed by the UTF-8 text
+
+Stations are sorted by grid cell, so each cell is just a range of rows. That
+way the index can be built straight from the cell table.
+
+To (re)build a snapshot, run one of:
+
+    python snapshot.py build <nrel-export.json> [snapshot path]
+    python snapshot.py fetch [snapshot path]
+
+New snapshots are written to a temporary file and then renamed over the old
+one, so workers never see a half-written file. Each one carries a new
+generation number, and running workers switch over on their next check.
+=========================================================================== """
+import json, math, mmap, os, struct, sys, time
+from models import Station
+
+
+MAGIC = b'WAYPOINT'
+VERSION = 1
+
+# magic, version, generation, stations, cells, strings, cell size, then the
+# byte offset of each section below.
+HEADER = struct.Struct('<8sIQIIId10Q')
+SECTIONS = ('latitude', 'longitude', 'id', 'flags', 'level1', 'level2',
+            'dc_fast', 'strings', 'cells', 'string_table')
+
+# The text fields we keep for each station, in column order.
+TEXT_FIELDS = ('station_name', 'street_address', 'city', 'state', 'zip',
+               'ev_network', 'ev_pricing', 'access_days_time')
+
+# Connector types NREL reports, each stored as one bit of the flags column.
+CONNECTORS = ('NEMA1450', 'NEMA515', 'NEMA520', 'J1772', 'J1772COMBO',
+              'CHADEMO', 'TESLA')
+FREE_PRICING = 1 << 16
+
+CELL = struct.Struct('<iiII')
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def write_snapshot(stations, path, cell_size=0.25):
+    """ Writes a list of stations (or NREL station dicts) to a snapshot file.
+        The file is swapped in atomically, so readers never see it half done. """
+    stations = [Station.from_dict(s) if isinstance(s, dict) else s for s in stations]
+    stations = [s for s in stations if s.latitude is not None and s.longitude is not None]
+
+    def cell(s):
+        return (math.floor(s.latitude / cell_size), math.floor(s.longitude / cell_size))
+    stations.sort(key=cell)
+
+    # Strings are de-duplicated, since lots of stations share a city or network.
+    strings, string_ids = [], {}
+    def string_id(value):
+        value = value or ''
+        if value not in string_ids:
+            string_ids[value] = len(strings)
+            strings.append(value)
+        return string_ids[value]
+
+    n = len(stations)
+    text = [string_id(getattr(s, field)) for s in stations for field in TEXT_FIELDS]
+
+    flags = []
+    for s in stations:
+        bits = 0
+        for c in s.ev_connector_types or []:
+            if c.upper() in CONNECTORS:
+                bits |= 1 << CONNECTORS.index(c.upper())
+        if 'free' in (s.ev_pricing or '').lower():
+            bits |= FREE_PRICING
+        flags.append(bits)
+
+    cells, start = [], 0
+    for i, s in enumerate(stations):
+        if i == n - 1 or cell(stations[i + 1]) != cell(s):
+            cells.append(cell(s) + (start, i + 1 - start))
+            start = i + 1
+
+    encoded = [value.encode('utf-8') for value in strings]
+    string_offsets, total = [], 0
+    for value in encoded:
+        string_offsets.append(total)
+        total += len(value)
+    string_offsets.append(total)
+
+    sections = [struct.pack('<{}d'.format(n), *(s.latitude for s in stations)),
+                struct.pack('<{}d'.format(n), *(s.longitude for s in stations)),
+                struct.pack('<{}I'.format(n), *(int(s.id or 0) for s in stations)),
+                struct.pack('<{}I'.format(n), *flags),
+                struct.pack('<{}H'.format(n), *(s.ev_level1_evse_num or 0 for s in stations)),
+                struct.pack('<{}H'.format(n), *(s.ev_level2_evse_num or 0 for s in stations)),
+                struct.pack('<{}H'.format(n), *(s.ev_dc_fast_num or 0 for s in stations)),
+                struct.pack('<{}I'.format(len(text)), *text),
+                b''.join(CELL.pack(*c) for c in cells),
+                struct.pack('<{}I'.format(len(string_offsets)), *string_offsets) + b''.join(encoded)]
+
+    offsets, position = [], _align(HEADER.size)
+    for section in sections:
+        offsets.append(position)
+        position = _align(position + len(section))
+
+    header = HEADER.pack(MAGIC, VERSION, time.time_ns(), n, len(cells), len(strings),
+                         cell_size, *offsets)
+
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as writer:
+        writer.write(header)
+        for offset, section in zip(offsets, sections):
+            writer.seek(offset)
+            writer.write(section)
+        writer.truncate(position)
+        writer.flush()
+        os.fsync(writer.fileno())
+    os.replace(tmp, path)
+    return path
+
+
+class Snapshot:
+    """ A memory-mapped, read-only station snapshot. Indexing it by row gives
+        you a Station, built on demand from the columns. """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = HEADER.unpack_from(self._mmap, 0)
+        magic, version, self.generation, n, ncells, nstrings, self.cell_size = header[:7]
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a version {} station snapshot.".format(path, VERSION))
+        offsets = dict(zip(SECTIONS, header[7:]))
+        self.count, self.cell_count = n, ncells
+
+        view = memoryview(self._mmap)
+        def column(name, fmt, length):
+            start = offsets[name]
+            return view[start:start + length * struct.calcsize(fmt)].cast(fmt)
+
+        self.lats = column('latitude', 'd', n)
+        self.lons = column('longitude', 'd', n)
+        self.ids = column('id', 'I', n)
+        self.flags = column('flags', 'I', n)
+        self.level1 = column('level1', 'H', n)
+        self.level2 = column('level2', 'H', n)
+        self.dc_fast = column('dc_fast', 'H', n)
+        self.text = column('strings', 'I', n * len(TEXT_FIELDS))
+        self._cells_offset = offsets['cells']
+        self._string_offsets = column('string_table', 'I', nstrings + 1)
+        self._string_base = offsets['string_table'] + (nstrings + 1) * 4
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, row):
+        return self.station(row)
+
+    def string(self, index):
+        start = self._string_base + self._string_offsets[index]
+        end = self._string_base + self._string_offsets[index + 1]
+        return self._mmap[start:end].decode('utf-8')
+
+    def station(self, row):
+        """ Builds the Station record for a row. """
+        station = Station.__new__(Station)
+        base = row * len(TEXT_FIELDS)
+        for k, field in enumerate(TEXT_FIELDS):
+            setattr(station, field, self.string(self.text[base + k]) or None)
+        flags = self.flags[row]
+        station.id = self.ids[row]
+        station.latitude = self.lats[row]
+        station.longitude = self.lons[row]
+        station.ev_connector_types = [c for i, c in enumerate(CONNECTORS) if flags & (1 << i)]
+        station.ev_level1_evse_num = self.level1[row] or None
+        station.ev_level2_evse_num = self.level2[row] or None
+        station.ev_dc_fast_num = self.dc_fast[row] or None
+        station.distance = None
+        return station
+
+    def cells(self):
+        """ Returns the grid as {cell: range of rows}, straight from the cell
+            table. The ranges don't copy anything. """
+        cells = {}
+        for k in range(self.cell_count):
+            i, j, start, count = CELL.unpack_from(self._mmap, self._cells_offset + k * CELL.size)
+            cells[(i, j)] = range(start, start + count)
+        return cells
+
+    def changed(self):
+        """ True if the file on disk has been replaced since we opened it. """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino, stat.st_mtime_ns) != (self.stat.st_ino, self.stat.st_mtime_ns)
+
+
+if __name__ == '__main__':
+    from config import settings
+    from index import fetch_all_stations
+
+    cell_size = settings['Index'].get('CELL_SIZE', 0.25)
+    default_path = settings['Index'].get('SNAPSHOT', 'instance/stations.snapshot')
+    command, args = (sys.argv[1:2] or [''])[0], sys.argv[2:]
+
+    if command == 'build' and args:
+        with open(args[0], 'rb') as f:
+            stations = json.load(f)['fuel_stations']
+        path = args[1] if len(args) > 1 else default_path
+    elif command == 'fetch':
+        stations = fetch_all_stations()
+        path = args[0] if args else default_path
+    else:
+        print(__doc__)
+        sys.exit(1)
+
+    write_snapshot(stations, path, cell_size)
+    print("Wrote {} stations to {}".format(len(stations), path))
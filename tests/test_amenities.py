@@ -0,0 +1,37 @@
+""" test_amenities.py =========================================================
+Checks which category the things people say fall under (see categories_for in
+amenities.py). Run from the top of the repo, like the skill itself:
+
+    python -m pytest tests
+=========================================================================== """
+import os, sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Keeps the shared index out of instance/ while we're at it.
+os.environ.setdefault('WAYPOINT__Amenities__PATH', ':memory:')
+
+from amenities import AmenityIndex, CATEGORIES
+
+
+# What some things people say should match. None means we don't know, and go
+# to Yelp. Only whole words count, so "steakhouse" isn't coffee.
+KEYWORDS = [('coffee', ['coffee']),
+            ('somewhere to eat', ['food']),
+            ('Tea', ['coffee']),
+            ('steakhouse', None),
+            ('theater', None),
+            ('seats', None),
+            ('workshop', None),
+            ('', list(CATEGORIES))]
+
+
+@pytest.fixture(scope='module')
+def index():
+    # The built-in categories, not whatever is configured.
+    return AmenityIndex(':memory:')
+
+
+@pytest.mark.parametrize('keyword, expected', KEYWORDS)
+def test_categories_for(index, keyword, expected):
+    assert index.categories_for(keyword) == expected
@@ -0,0 +1,155 @@
+""" tracing.py ================================================================
+It's really handy to look at the actual requests Alexa sends us, and the
+responses we send back. But writing them to disk in the middle of a request
+means every user waits on the disk. Instead, we capture them here.
+
+A sample of requests (set by SAMPLE_RATE) get their envelopes saved to a small
+ring buffer in memory, which only keeps the most recent BUFFER_SIZE entries.
+Captured entries are also handed to a background thread that writes them out
+in batches to a rotating .jsonl file. Serializing happens on that thread too,
+so capturing an entry on the request path is just a couple of appends.
+
+To see what's in the ring buffer right now, call trace_buffer.dump(), or send
+the server process a SIGUSR1 signal.
+=========================================================================== """
+import json, os, queue, random, signal, threading, time
+from collections import deque
+from ask_sdk_core.serialize import DefaultSerializer
+from config import logger, settings
+
+
+serializer = DefaultSerializer()
+
+
+class TraceBuffer:
+    """ A bounded, sampled ring buffer of request/response envelopes. """
+
+    def __init__(self, path, sample_rate=0.05, buffer_size=200, batch_size=50,
+                 flush_interval=5.0, max_bytes=10485760, backups=3):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0
+        self._ring = deque(maxlen=buffer_size)
+        self._pending = queue.Queue(maxsize=buffer_size * 10)
+        self._sampled = deque(maxlen=buffer_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def sampled(self, request_id):
+        """ Decides once per request whether it gets traced, so that its
+            request, response and anything in between are kept together. """
+        if request_id in self._sampled:
+            return True
+        if random.random() < self.sample_rate:
+            self._sampled.append(request_id)
+            return True
+        return False
+
+    def capture(self, request_id, kind, payload):
+        """ Save an entry for a sampled request. Never blocks: if the writer
+            thread falls too far behind, we drop the entry instead. """
+        if not self.sampled(request_id):
+            return
+        entry = (time.time(), request_id, kind, payload)
+        self._ring.append(entry)
+        if self.path:
+            try:
+                self._pending.put_nowait(entry)
+            except queue.Full:
+                self.dropped += 1
+
+    def entries(self):
+        """ Returns a serialized copy of everything in the ring buffer. """
+        return [self._serialize(entry) for entry in list(self._ring)]
+
+    def dump(self, path=None):
+        """ Writes the current contents of the ring buffer to a file. """
+        path = path or os.path.splitext(self.path)[0] + '-dump.json'
+        with open(path, 'w') as writer:
+            json.dump(self.entries(), writer, indent=2, default=str)
+        logger.info("Dumped {} trace entries to {}".format(len(self._ring), path))
+        return path
+
+    @staticmethod
+    def _serialize(entry):
+        timestamp, request_id, kind, payload = entry
+        if isinstance(payload, BaseException):
+            payload = repr(payload)
+        elif not hasattr(payload, 'deserialized_types') and hasattr(payload, 'to_dict'):
+            # Our own models (see models.py), as opposed to the ask_sdk ones.
+            payload = payload.to_dict()
+        return {'time': timestamp, 'request_id': request_id, 'kind': kind,
+                'payload': serializer.serialize(payload)}
+
+    def start(self):
+        """ Starts the background writer thread. """
+        with self._lock:
+            if self._thread is None and self.path:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    logger.warning("Failed to write trace batch: {}".format(e))
+
+    def _take_batch(self):
+        """ Waits for up to flush_interval seconds, or until a full batch. """
+        batch, deadline = [], time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._pending.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        lines = ''.join(json.dumps(self._serialize(entry), default=str) + '\n'
+                        for entry in batch)
+        if os.path.exists(self.path) and os.path.getsize(self.path) + len(lines) > self.max_bytes:
+            self._rotate()
+        with open(self.path, 'a') as writer:
+            writer.write(lines)
+
+    def _rotate(self):
+        """ trace.jsonl becomes trace.jsonl.1, .1 becomes .2, and so on. """
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('{}.{}'.format(self.path, i)):
+                os.replace('{}.{}'.format(self.path, i), '{}.{}'.format(self.path, i + 1))
+        if self.backups:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+
+def install_signal_handler(buffer, signum=getattr(signal, 'SIGUSR1', None)):
+    """ Dump the ring buffer whenever the process gets a SIGUSR1. This only
+        works from the main thread, so call it at startup. """
+    if signum is not None:
+        signal.signal(signum, lambda *args: buffer.dump())
+
+
+def make_trace_buffer():
+    """ Builds our trace buffer from the "Trace" block of our config. In debug
+        mode we keep every request instead of a sample. """
+    config = settings.get('Trace') or {}
+    sample_rate = 1.0 if settings['Debug']['debugMode'] else config.get('SAMPLE_RATE', 0.05)
+    return TraceBuffer(config.get('PATH', 'instance/trace.jsonl'),
+                       sample_rate=sample_rate,
+                       buffer_size=config.get('BUFFER_SIZE', 200),
+                       batch_size=config.get('BATCH_SIZE', 50),
+                       flush_interval=config.get('FLUSH_INTERVAL', 5.0),
+                       max_bytes=config.get('MAX_BYTES', 10485760),
+                       backups=config.get('BACKUPS', 3))
+
+
+# This is the trace buffer shared by the whole app.
+trace_buffer = make_trace_buffer()